@@ -7,20 +7,35 @@ Telegram Auto-Join Bot - 自动加群/加频道机器人
 
 import os
 import asyncio
+import atexit
 import logging
+import logging.handlers
+import queue
 import zipfile
 import tempfile
 import random
 import re
 import shutil
-from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Tuple
+import functools
+import csv
+import heapq
+import gzip
+import io
+import json
+import time
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, List, Tuple, Iterator, AsyncIterator, Callable, BinaryIO
 from pathlib import Path
+from enum import IntEnum
+from collections import OrderedDict, deque
 
 # Telegram libraries
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
@@ -29,36 +44,271 @@ from telegram.ext import (
     filters,
 )
 
-from telethon import TelegramClient, functions, errors
+from telethon import TelegramClient, functions, errors, types
 from telethon.sessions import StringSession
 import aiosqlite
 import socks
 
+# ============== 日志 ==============
+
+class CompressedRotatingFileHandler(logging.handlers.BaseRotatingHandler):
+    """按大小或时间 (每天零点) 轮转的日志文件，旧文件 gzip 压缩后保留 backup_count 个
+    只在日志线程中调用，轮转和压缩不占用事件循环
+    """
+    
+    def __init__(self, filename: str, max_bytes: int, backup_count: int):
+        super().__init__(filename, "a", encoding="utf-8")
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        # 按文件最后写入时间计算；启动时若是昨天的文件，第一条日志就会触发轮转
+        self.rollover_at = self._next_midnight(os.path.getmtime(self.baseFilename))
+    
+    @staticmethod
+    def _next_midnight(ts: float) -> float:
+        day = datetime.fromtimestamp(ts).date() + timedelta(days=1)
+        return datetime.combine(day, datetime.min.time()).timestamp()
+    
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if time.time() >= self.rollover_at:
+            return True
+        return self.max_bytes > 0 and self.stream is not None and self.stream.tell() >= self.max_bytes
+    
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+            dest = f"{self.baseFilename}.{stamp}.gz"
+            n = 1
+            while os.path.exists(dest):
+                dest = f"{self.baseFilename}.{stamp}-{n}.gz"
+                n += 1
+            with open(self.baseFilename, "rb") as src, gzip.open(dest, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.baseFilename)
+            self._remove_old_backups()
+        
+        self.rollover_at = self._next_midnight(time.time())
+        self.stream = self._open()
+    
+    def _remove_old_backups(self):
+        log_dir, name = os.path.split(self.baseFilename)
+        backups = sorted(
+            (os.path.join(log_dir, f) for f in os.listdir(log_dir)
+             if f.startswith(name + ".") and f.endswith(".gz")),
+            key=os.path.getmtime,
+        )
+        for path in backups[:-self.backup_count] if self.backup_count > 0 else []:
+            os.remove(path)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """日志交给后台线程写入；队列满 (磁盘卡顿) 时丢弃并计数，不阻塞调用方"""
+    
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogSampler(logging.Filter):
+    """热点日志采样: 同一类日志每 interval 秒只放行一条，并附上期间省略的条数
+    分类取 logger.info(..., extra={"sample": "<key>"})，或 sampled_loggers 中的 logger 名
+    WARNING 及以上不采样
+    """
+    
+    def __init__(self, interval: float, sampled_loggers: Tuple[str, ...] = ()):
+        super().__init__()
+        self.interval = interval
+        self.sampled_loggers = frozenset(sampled_loggers)
+        self.suppressed_total = 0
+        self._last_emit: Dict[str, float] = {}
+        self._suppressed: Dict[str, int] = {}
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key = getattr(record, "sample", None)
+        if key is None:
+            if record.name not in self.sampled_loggers:
+                return True
+            key = record.name
+        
+        now = time.monotonic()
+        last = self._last_emit.get(key)
+        if last is not None and now - last < self.interval:
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            self.suppressed_total += 1
+            return False
+        
+        self._last_emit[key] = now
+        skipped = self._suppressed.pop(key, 0)
+        if skipped:
+            record.msg = f"{record.getMessage()} (此前省略 {skipped} 条同类日志)"
+            record.args = None
+        return True
+
+
+def setup_logging(log_path: str, max_bytes: int, backup_count: int, queue_size: int,
+                  sample_interval: float, sampled_loggers: Tuple[str, ...]) -> Tuple[NonBlockingQueueHandler, LogSampler]:
+    """根 logger 只挂一个队列 handler，文件和控制台由后台线程写入 (退出时写完剩余日志)"""
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    file_handler = CompressedRotatingFileHandler(log_path, max_bytes, backup_count)
+    console_handler = logging.StreamHandler()
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+    
+    queue_handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+    sampler = LogSampler(sample_interval, sampled_loggers)
+    queue_handler.addFilter(sampler)
+    
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(queue_handler)
+    
+    listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, console_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return queue_handler, sampler
+
 # ============== 配置 ==============
 BOT_TOKEN = os.getenv("BOT_TOKEN", "YOUR_BOT_TOKEN")
 API_ID = int(os.getenv("API_ID", "0")) if os.getenv("API_ID") else 0
 API_HASH = os.getenv("API_HASH", "YOUR_API_HASH")
+# 管理员用户 id (逗号分隔)，可使用 /perf 等管理命令
+ADMIN_IDS = {int(i) for i in os.getenv("ADMIN_IDS", "").split(",") if i.strip()}
 
 # 文件上传限制
 MAX_ZIP_FILE_SIZE = 100 * 1024 * 1024  # 100MB
+UPLOAD_SPOOL_THRESHOLD = 8 * 1024 * 1024  # 上传文件超过该大小 (或大小未知) 时写入临时文件
+
+# 统计写入缓冲
+STATS_FLUSH_BATCH_SIZE = 200      # 攒够条数立即写入
+STATS_FLUSH_INTERVAL = 1.0        # 最长缓冲时间 (秒)
+STATS_QUEUE_MAXSIZE = 10000       # 队列上限，满时 add_stat 等待
+STATS_QUEUE_WARN_DEPTH = 5000     # 积压告警阈值
+STATS_PENDING_MAX = 50000         # 写入持续失败时最多保留的待写记录数
+
+# 统计保留与归档
+STATS_RETENTION_DAYS = int(os.getenv("STATS_RETENTION_DAYS", "0"))  # 0 表示不归档 (默认)
+STATS_ARCHIVE_INTERVAL = 3600      # 归档检查间隔 (秒)
+STATS_ARCHIVE_BATCH_SIZE = 5000    # 每批归档/导出条数
+INCREMENTAL_VACUUM_PAGES = 1000    # 每步回收页数
+INCREMENTAL_VACUUM_PAUSE = 0.2     # 两步之间让出写锁的时间 (秒)
+
+# 链接导入
+LINK_IMPORT_CHUNK_SIZE = 64 * 1024  # 每次读取字节数
+LINK_IMPORT_BATCH_SIZE = 1000       # 每个事务插入条数
+MAX_LINK_LENGTH = 256
+MAX_IMPORT_LINE_LENGTH = 4 * MAX_LINK_LENGTH  # 超过该长度的行直接判为无效，不整行缓存
+
+# 任务内账户客户端连接池
+CLIENT_POOL_MAX_SIZE = 50                 # 同时保持连接的账户数上限
+CLIENT_POOL_IDLE_TIMEOUT = 300            # 空闲超过该秒数断开
+CLIENT_POOL_HEALTH_CHECK_INTERVAL = 60    # 空闲超过该秒数复用前做一次 RPC 检查
+CLIENT_POOL_HEALTH_CHECK_TIMEOUT = 10
+
+# 代理健康检测
+PROXY_CHECK_CONCURRENCY = 20   # 同时检测的代理数
+PROXY_CHECK_TIMEOUT = 15       # 单个代理连接超时 (秒)
+
+# 账户状态刷新
+ACCOUNT_CHECK_CONCURRENCY = 10   # 同时检查的账户数
+ACCOUNT_CHECK_TIMEOUT = 30       # 单个账户检查超时 (秒)
+
+# ZIP 批量导入 session 验证
+SESSION_VALIDATE_CONCURRENCY = 10   # 同时验证的 session 数
+SESSION_VALIDATE_TIMEOUT = 60       # 单个 session 验证超时 (秒)
+
+# 停止任务后等待其自行结束的最长时间 (秒)，超时则取消
+TASK_STOP_GRACE = 5
+# 关闭机器人时等待所有任务收尾的最长时间 (秒)，超时则取消
+TASK_SHUTDOWN_TIMEOUT = 15
+
+# 进度消息最短编辑间隔 (秒)
+PROGRESS_EDIT_INTERVAL = 2.0
+TASK_PROGRESS_INTERVAL = 5.0   # 加群任务状态消息
+TASK_RECENT_ERRORS = 5         # 状态消息中显示的最近错误条数
+
+# Bot API 发送限流 (每秒请求数)
+BOT_API_GLOBAL_RATE = 25           # 全局
+BOT_API_GLOBAL_BURST = 30
+BOT_API_CHAT_RATE = 1.0            # 单个私聊
+BOT_API_CHAT_BURST = 3
+BOT_API_GROUP_RATE = 20 / 60       # 单个群组
+BOT_API_GROUP_BURST = 3
+BOT_API_CHAT_LIMITERS_MAX = 10000  # 超出后清理空闲聊天的限流器
+BOT_API_MAX_RETRIES = 3            # RetryAfter 最多重试次数
+
+# 发送优先级 (rate_limit_args)，数值越小越先发送
+SEND_PRIORITY_INTERACTIVE = 0      # 菜单/操作回复
+SEND_PRIORITY_BACKGROUND = 1       # 后台任务进度、通知
+
+# 用户设置缓存
+SETTINGS_CACHE_MAX_USERS = 10000   # 最多缓存的用户数
+SETTINGS_CACHE_IDLE_TTL = 3600     # 空闲超过该秒数淘汰
+
+# 按字符串批量查字典表 id 时每条 SQL 的参数个数
+REF_LOOKUP_CHUNK = 500
+
+# 加群任务每次从数据库读取的链接数 (边读边跑，不一次性载入全部链接)
+TASK_LINK_CHUNK = 500
+
+# 列表分页每页条数
+LINKS_PAGE_SIZE = 20
+ACCOUNTS_PAGE_SIZE = 20
+LOGS_PAGE_SIZE = 10
+
+# 统计面板
+DASHBOARD_RANGES = (1, 7, 30)   # 可选时间范围 (天)
+DASHBOARD_TREND_DAYS = 7        # 逐日明细显示的天数
+DASHBOARD_TOP_ACCOUNTS = 5
+
+# 按钮回调耗时统计: 每个路由保留的最近样本数
+ROUTE_TIMING_WINDOW = 1000
+
+# 事件循环延迟监控
+LOOP_LAG_INTERVAL = 0.1          # 采样间隔 (秒)，阻塞时长最多被低估这么多
+LOOP_LAG_WARN_THRESHOLD = 0.2    # 延迟超过该秒数时记录告警和最慢的处理函数
+LOOP_LAG_WINDOW = 1000           # 保留的最近延迟样本数 / 已结束的处理函数数
+
+# 日志
+LOG_MAX_BYTES = 20 * 1024 * 1024    # bot.log 超过该大小轮转 (另外每天零点轮转)
+LOG_BACKUP_COUNT = 14               # 保留的压缩旧日志个数
+LOG_QUEUE_MAXSIZE = 10000           # 待写日志队列上限，满时丢弃
+LOG_SAMPLE_INTERVAL = 60            # 热点日志每类每隔多少秒记录一条
+LOG_SAMPLED_LOGGERS = ("httpx",)    # 整体采样的第三方 logger (每次 API 请求一条 INFO)
+
+# 用户名解析缓存
+ENTITY_CACHE_TTL = 3 * 24 * 3600      # 解析结果有效期 (秒)
+ENTITY_CACHE_MAX_ENTRIES = 50000      # 超出后按最近使用时间淘汰
+ENTITY_CACHE_TOUCH_INTERVAL = 3600    # 命中时最近使用时间早于该秒数才写回
+ENTITY_CACHE_EVICT_EVERY = 1000       # 每新增多少条检查一次容量
 
 DB_PATH = "jqbot.db"
 SESSIONS_DIR = "sessions"
 LOGS_DIR = "logs"
+REPORTS_DIR = "reports"
+ARCHIVE_DIR = "archives"
 PROXY_FILE = "proxy.txt"
 
 # 创建必要的目录
 os.makedirs(SESSIONS_DIR, exist_ok=True)
 os.makedirs(LOGS_DIR, exist_ok=True)
+os.makedirs(REPORTS_DIR, exist_ok=True)
+os.makedirs(ARCHIVE_DIR, exist_ok=True)
 
-# 日志配置
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler(f"{LOGS_DIR}/bot.log"),
-        logging.StreamHandler()
-    ]
+# 日志配置 (队列 + 后台线程写入，按大小/时间轮转压缩)
+log_queue_handler, log_sampler = setup_logging(
+    f"{LOGS_DIR}/bot.log", LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_QUEUE_MAXSIZE,
+    LOG_SAMPLE_INTERVAL, LOG_SAMPLED_LOGGERS,
 )
 logger = logging.getLogger(__name__)
 
@@ -71,17 +321,302 @@ logger = logging.getLogger(__name__)
     SET_LIMIT,
 ) = range(5)
 
-# 任务状态
-task_running = {}
-task_paused = {}
+# 任务状态: user_id -> TaskController
+task_controllers = {}
+
+# ============== 工具函数 ==============
+
+def percentile(values: List[float], pct: float) -> float:
+    """最近秩法百分位数，values 为空时返回 0"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+# ============== 事件循环监控 ==============
+
+class LoopLagMonitor:
+    """事件循环延迟监控
+    每 interval 秒安排一次唤醒，记录实际比预期晚了多少 (同步阻塞操作会直接体现为延迟)；
+    超过 threshold 时记录告警，附上这段时间内运行过的处理函数 (按耗时降序)
+    """
+    
+    def __init__(self, interval: float, threshold: float, window: int):
+        self.interval = interval
+        self.threshold = threshold
+        self.samples: deque = deque(maxlen=window)     # 最近的延迟 (毫秒)
+        self.max_lag_ms = 0.0
+        self.spikes = 0
+        self._active: Dict[int, Tuple[str, float]] = {}
+        self._finished: deque = deque(maxlen=window)   # (名称, 开始, 结束)
+        self._next_token = 0
+        self._task: Optional[asyncio.Task] = None
+    
+    @contextmanager
+    def track(self, name: str):
+        """标记一段处理函数的运行区间"""
+        token = self._next_token
+        self._next_token += 1
+        self._active[token] = (name, time.perf_counter())
+        try:
+            yield
+        finally:
+            name, started = self._active.pop(token)
+            self._finished.append((name, started, time.perf_counter()))
+    
+    def slowest(self, since: float, limit: int = 5) -> List[Tuple[str, float]]:
+        """since (perf_counter) 之后仍在运行或结束的处理函数 [(名称, 耗时毫秒)]"""
+        now = time.perf_counter()
+        rows = [(name, (end - started) * 1000) for name, started, end in self._finished if end >= since]
+        rows += [(f"{name} (运行中)", (now - started) * 1000) for name, started in self._active.values()]
+        rows.sort(key=lambda row: -row[1])
+        return rows[:limit]
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            scheduled = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - scheduled - self.interval)
+            lag_ms = lag * 1000
+            self.samples.append(lag_ms)
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            
+            if lag >= self.threshold:
+                self.spikes += 1
+                slowest = ", ".join(f"{name} {ms:.0f}ms" for name, ms in self.slowest(scheduled)) or "无"
+                logger.warning(f"事件循环延迟 {lag_ms:.0f} ms，期间的处理函数: {slowest}")
+
+
+loop_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL, LOOP_LAG_WARN_THRESHOLD, LOOP_LAG_WINDOW)
+
+
+def monitored(callback: Callable) -> Callable:
+    """包装更新处理函数，运行区间计入 loop_monitor"""
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with loop_monitor.track(callback.__name__):
+            return await callback(update, context)
+    return wrapper
+
+# ============== 消息发送限流 ==============
+
+class PriorityLimiter:
+    """令牌桶限流，等待者按 (优先级, 到达顺序) 获得令牌"""
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self._granter: Optional[asyncio.Task] = None
+    
+    @property
+    def depth(self) -> int:
+        return len(self._waiters)
+    
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return not self._waiters and self.tokens >= self.burst
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def acquire(self, priority: int):
+        self._refill()
+        if not self._waiters and self.tokens >= 1 and time.monotonic() >= self.blocked_until:
+            self.tokens -= 1
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        if self._granter is None or self._granter.done():
+            self._granter = asyncio.create_task(self._grant())
+        await future
+    
+    async def _grant(self):
+        """按优先级依次发放令牌"""
+        while self._waiters:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():   # 等待者已取消
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+    
+    def block(self, seconds: float):
+        """收到 RetryAfter 后暂停发放"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class PendingEdit:
+    """排队中的 editMessageText，同一消息的后续编辑直接替换内容"""
+    
+    __slots__ = ("callback", "args", "kwargs", "future", "merged")
+    
+    def __init__(self, callback, args, kwargs):
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.merged = 0
+
+
+class BotDispatcher(BaseRateLimiter[int]):
+    """所有 Bot API 请求的统一出口
+    
+    - 全局和每个聊天各一个令牌桶 (群组使用更低的速率)
+    - rate_limit_args 为优先级，交互回复 (默认) 先于后台任务通知
+    - 同一条消息还在排队的编辑会被合并，只发送最新内容
+    - 收到 RetryAfter 时全局暂停对应时间后重试
+    """
+    
+    def __init__(self):
+        self._global = PriorityLimiter(BOT_API_GLOBAL_RATE, BOT_API_GLOBAL_BURST)
+        self._chats: Dict[int, PriorityLimiter] = {}
+        self._pending_edits: Dict[Tuple, PendingEdit] = {}
+        self.merged_edits = 0
+        self.retry_after_count = 0
+    
+    @property
+    def depth(self) -> int:
+        """等待发送的请求数"""
+        return self._global.depth + sum(limiter.depth for limiter in self._chats.values())
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        for pending in self._pending_edits.values():
+            if not pending.future.done():
+                pending.future.cancel()
+        self._pending_edits.clear()
+    
+    def _chat_limiter(self, chat_id) -> PriorityLimiter:
+        limiter = self._chats.get(chat_id)
+        if limiter is None:
+            if len(self._chats) >= BOT_API_CHAT_LIMITERS_MAX:
+                # 清理空闲的聊天限流器
+                for key in [k for k, v in self._chats.items() if v.idle]:
+                    del self._chats[key]
+            # 群组 (负 id) 限制更严格
+            if isinstance(chat_id, int) and chat_id < 0:
+                limiter = PriorityLimiter(BOT_API_GROUP_RATE, BOT_API_GROUP_BURST)
+            else:
+                limiter = PriorityLimiter(BOT_API_CHAT_RATE, BOT_API_CHAT_BURST)
+            self._chats[chat_id] = limiter
+        return limiter
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if rate_limit_args is not None else SEND_PRIORITY_INTERACTIVE
+        chat_id = data.get("chat_id")
+        
+        # 合并同一消息的排队编辑
+        edit_key = None
+        if endpoint == "editMessageText":
+            edit_key = (chat_id, data.get("message_id"), data.get("inline_message_id"))
+            pending = self._pending_edits.get(edit_key)
+            if pending is not None:
+                pending.callback, pending.args, pending.kwargs = callback, args, kwargs
+                pending.merged += 1
+                self.merged_edits += 1
+                return await asyncio.shield(pending.future)
+            pending = PendingEdit(callback, args, kwargs)
+            self._pending_edits[edit_key] = pending
+        
+        try:
+            if chat_id is not None:
+                await self._chat_limiter(chat_id).acquire(priority)
+            await self._global.acquire(priority)
+        except BaseException:
+            if edit_key is not None:
+                self._pending_edits.pop(edit_key, None)
+                if not pending.future.done():
+                    pending.future.cancel()
+            raise
+        
+        if edit_key is None:
+            return await self._call_with_retry(callback, args, kwargs, endpoint)
+        
+        # 开始发送后不再合并，之后的编辑重新排队
+        self._pending_edits.pop(edit_key, None)
+        try:
+            result = await self._call_with_retry(pending.callback, pending.args, pending.kwargs, endpoint)
+        except BaseException as e:
+            if pending.merged:
+                if isinstance(e, Exception):
+                    pending.future.set_exception(e)
+                else:
+                    pending.future.cancel()
+            raise
+        if pending.merged:
+            pending.future.set_result(result)
+        return result
+    
+    async def _call_with_retry(self, callback, args, kwargs, endpoint):
+        for attempt in range(BOT_API_MAX_RETRIES + 1):
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                seconds = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                self.retry_after_count += 1
+                if attempt >= BOT_API_MAX_RETRIES:
+                    logger.error(f"{endpoint} 多次触发限流，放弃发送")
+                    raise
+                logger.warning(f"{endpoint} 触发限流，暂停 {seconds:.0f} 秒后重试")
+                self._global.block(seconds)
+                await self._global.acquire(SEND_PRIORITY_INTERACTIVE)
+
+
+bot_dispatcher = BotDispatcher()
 
-# 代理管理
-proxy_list = []
-proxy_index = 0
 
 # ============== 代理管理 ==============
 
-def parse_proxy_line(line: str) -> Optional[Dict]:
+class ProxyRecord:
+    """解析后的单个代理"""
+    __slots__ = ("type", "host", "port", "username", "password", "raw")
+    
+    def __init__(self, proxy_type: int, host: str, port: int,
+                 username: Optional[str], password: Optional[str], raw: str):
+        self.type = proxy_type
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.raw = raw
+
+
+def parse_proxy_line(line: str) -> Optional[ProxyRecord]:
     """解析单行代理，支持多种格式"""
     line = line.strip()
     
@@ -155,94 +690,145 @@ def parse_proxy_line(line: str) -> Optional[Dict]:
             logger.warning(f"无效的端口号: {port}")
             return None
         
-        return {
-            'type': proxy_type,
-            'host': host,
-            'port': port,
-            'username': username,
-            'password': password,
-            'raw': line
-        }
+        return ProxyRecord(proxy_type, host, port, username, password, line)
     
     except Exception as e:
         logger.warning(f"解析代理失败: {line}, 错误: {e}")
         return None
 
 
-def load_proxies() -> List[Dict]:
-    """从 proxy.txt 加载代理列表"""
-    global proxy_list
-    proxy_list = []
+class ProxyRegistry:
+    """proxy.txt 的缓存视图
+    
+    解析结果常驻内存，只有文件的 mtime 或大小变化时才重新解析；
+    UI 和加群任务共用同一个实例 (proxy_registry)。
+    """
     
-    if not os.path.exists(PROXY_FILE):
-        logger.warning(f"代理文件不存在: {PROXY_FILE}")
-        return proxy_list
+    def __init__(self, path: str):
+        self.path = path
+        self._records: List[ProxyRecord] = []
+        self._signature: Optional[Tuple[int, int]] = None
+        self._missing_logged = False
+        self._index = 0
+        self._dead = set()
     
-    try:
-        with open(PROXY_FILE, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+    @property
+    def records(self) -> List[ProxyRecord]:
+        return self._records
+    
+    @property
+    def alive_records(self) -> List[ProxyRecord]:
+        """未被健康检测标记为失效的代理"""
+        if not self._dead:
+            return self._records
+        return [p for p in self._records if p.raw not in self._dead]
+    
+    def is_dead(self, proxy: ProxyRecord) -> bool:
+        return proxy.raw in self._dead
+    
+    def set_dead(self, raws):
+        """更新失效代理集合 (来自最近一次健康检测)"""
+        self._dead = set(raws)
+    
+    def refresh(self, force: bool = False) -> List[ProxyRecord]:
+        """文件有变化 (或 force) 时重新解析，返回代理列表"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            if not self._missing_logged:
+                logger.warning(f"代理文件不存在: {self.path}")
+                self._missing_logged = True
+            self._records = []
+            self._signature = None
+            return self._records
         
-        for line in lines:
-            proxy = parse_proxy_line(line)
-            if proxy:
-                proxy_list.append(proxy)
+        self._missing_logged = False
+        signature = (st.st_mtime_ns, st.st_size)
+        if not force and signature == self._signature:
+            return self._records
         
-        logger.info(f"成功加载 {len(proxy_list)} 个代理")
-    except Exception as e:
-        logger.error(f"加载代理文件失败: {e}")
+        try:
+            self._records = list(self._parse_file())
+            self._signature = signature
+            if self._index >= len(self._records):
+                self._index = 0
+            logger.info(f"成功加载 {len(self._records)} 个代理")
+        except Exception as e:
+            logger.error(f"加载代理文件失败: {e}")
+        
+        return self._records
+    
+    def next(self) -> Optional[ProxyRecord]:
+        """获取下一个代理（轮换使用，跳过失效代理；全部失效时退回全部代理）
+        只用内存中的列表，文件变化由 load_proxies 在线程中重新加载
+        """
+        records = self.alive_records or self._records
+        if not records:
+            return None
+        
+        proxy = records[self._index % len(records)]
+        self._index = (self._index + 1) % len(records)
+        return proxy
     
-    return proxy_list
+    def reset_rotation(self):
+        self._index = 0
+    
+    def _parse_file(self) -> Iterator[ProxyRecord]:
+        """逐行解析 (不一次性读入整个文件)"""
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                proxy = parse_proxy_line(line)
+                if proxy:
+                    yield proxy
+
+
+proxy_registry = ProxyRegistry(PROXY_FILE)
+
 
+async def load_proxies() -> List[ProxyRecord]:
+    """获取代理列表 (文件未变化时直接返回缓存，读文件在线程中进行)"""
+    return await asyncio.to_thread(proxy_registry.refresh)
 
-def get_proxy_for_telethon(proxy: Dict) -> Tuple:
+
+def get_proxy_for_telethon(proxy: ProxyRecord) -> Tuple:
     """转换为 Telethon 需要的 tuple 格式"""
-    if proxy['username'] and proxy['password']:
+    if proxy.username and proxy.password:
         return (
-            proxy['type'],
-            proxy['host'],
-            proxy['port'],
+            proxy.type,
+            proxy.host,
+            proxy.port,
             True,  # rdns
-            proxy['username'],
-            proxy['password']
+            proxy.username,
+            proxy.password
         )
     else:
         return (
-            proxy['type'],
-            proxy['host'],
-            proxy['port']
+            proxy.type,
+            proxy.host,
+            proxy.port
         )
 
 
-def get_next_proxy() -> Optional[Dict]:
+def get_next_proxy() -> Optional[ProxyRecord]:
     """获取下一个代理（轮换使用）"""
-    global proxy_index
-    
-    if not proxy_list:
-        return None
-    
-    proxy = proxy_list[proxy_index]
-    proxy_index = (proxy_index + 1) % len(proxy_list)
-    
-    return proxy
+    return proxy_registry.next()
 
 
-def reload_proxies() -> int:
+async def reload_proxies() -> int:
     """重新加载代理列表"""
-    global proxy_index
-    proxy_index = 0
-    proxies = load_proxies()
-    return len(proxies)
+    proxy_registry.reset_rotation()
+    return len(await asyncio.to_thread(proxy_registry.refresh, True))
 
 
-def mask_proxy(proxy: Dict) -> str:
+def mask_proxy(proxy: ProxyRecord) -> str:
     """脱敏显示代理信息"""
-    host = proxy['host']
-    port = proxy['port']
+    host = proxy.host
+    port = proxy.port
     
-    if proxy['username']:
+    if proxy.username:
         # 隐藏部分密码
-        username = proxy['username']
-        password = proxy['password']
+        username = proxy.username
+        password = proxy.password or ""
         if len(password) > 4:
             masked_pass = password[:2] + '*' * (len(password) - 4) + password[-2:]
         else:
@@ -252,232 +838,1837 @@ def mask_proxy(proxy: Dict) -> str:
         return f"{host}:{port}"
 
 
-async def test_proxy(proxy: Dict) -> Tuple[bool, str]:
-    """测试单个代理连通性"""
+async def check_proxy(proxy: ProxyRecord, timeout: float = PROXY_CHECK_TIMEOUT) -> Tuple[bool, Optional[float], Optional[str]]:
+    """经代理连接 Telegram 并计时
+    返回: (是否可用, 连接耗时毫秒, 错误信息)
+    """
+    client = None
+    started = time.monotonic()
     try:
-        proxy_tuple = get_proxy_for_telethon(proxy)
-        
-        # 创建临时 client 测试连接
+        # 只尝试一次，由外层超时控制总时长
         client = TelegramClient(
             StringSession(),
             API_ID,
             API_HASH,
-            proxy=proxy_tuple
+            proxy=get_proxy_for_telethon(proxy),
+            connection_retries=0,
+            timeout=timeout,
         )
-        
-        # 尝试连接
-        await client.connect()
-        connected = client.is_connected()
-        await client.disconnect()
-        
-        if connected:
-            return True, f"代理连接成功: {mask_proxy(proxy)}"
-        else:
-            return False, f"代理连接失败: {mask_proxy(proxy)}"
-    
+        await asyncio.wait_for(client.connect(), timeout)
+        latency_ms = (time.monotonic() - started) * 1000
+        if client.is_connected():
+            return True, latency_ms, None
+        return False, None, "未连接"
+    except asyncio.TimeoutError:
+        return False, None, "连接超时"
     except Exception as e:
-        logger.error(f"测试代理失败: {e}")
-        return False, f"代理测试异常: {mask_proxy(proxy)} - {str(e)}"
+        return False, None, str(e) or type(e).__name__
+    finally:
+        if client is not None:
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
 
 
-# ============== 数据库 ==============
+async def test_proxy(proxy: ProxyRecord) -> Tuple[bool, str]:
+    """测试单个代理连通性"""
+    ok, latency_ms, error = await check_proxy(proxy)
+    if ok:
+        return True, f"代理连接成功: {mask_proxy(proxy)} ({latency_ms:.0f}ms)"
+    logger.error(f"测试代理失败: {error}")
+    return False, f"代理测试异常: {mask_proxy(proxy)} - {error}"
 
-async def init_db():
-    """初始化数据库"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        # 账户表
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS accounts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                phone TEXT,
-                session_string TEXT,
-                status TEXT DEFAULT 'offline',
-                added_date DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # 链接表
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS links (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                link TEXT NOT NULL,
-                added_date DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # 统计表
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                account_id INTEGER,
-                link TEXT,
-                status TEXT,
-                message TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # 设置表
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                user_id INTEGER PRIMARY KEY,
-                interval_min INTEGER DEFAULT 30,
-                interval_max INTEGER DEFAULT 60,
-                daily_limit INTEGER DEFAULT 50
-            )
-        """)
-        
-        await db.commit()
 
-async def add_account(user_id: int, phone: str, session_string: str) -> int:
-    """添加账户"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            "INSERT INTO accounts (user_id, phone, session_string) VALUES (?, ?, ?)",
-            (user_id, phone, session_string)
-        )
-        await db.commit()
-        return cursor.lastrowid
+async def sweep_proxies(progress=None) -> Tuple[int, int]:
+    """并发检测全部代理，结果写入 proxy_health 并更新失效标记
+    progress: 可选回调 progress(已完成, 总数)
+    返回: (可用数量, 失效数量)
+    """
+    proxies = await load_proxies()
+    semaphore = asyncio.Semaphore(PROXY_CHECK_CONCURRENCY)
+    
+    async def check_one(proxy: ProxyRecord):
+        async with semaphore:
+            ok, latency_ms, error = await check_proxy(proxy)
+            return proxy.raw, ok, latency_ms, error
+    
+    results = []
+    for done, future in enumerate(asyncio.as_completed([check_one(p) for p in proxies]), 1):
+        results.append(await future)
+        if progress:
+            await progress(done, len(proxies))
+    
+    await save_proxy_health(results)
+    dead = [raw for raw, ok, _, _ in results if not ok]
+    proxy_registry.set_dead(dead)
+    logger.info(f"代理检测完成: 可用 {len(results) - len(dead)}，失效 {len(dead)}")
+    return len(results) - len(dead), len(dead)
 
-async def get_accounts(user_id: int) -> List[Dict]:
-    """获取用户的所有账户"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT * FROM accounts WHERE user_id = ?", (user_id,)
-        ) as cursor:
-            rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
 
-async def delete_account(account_id: int):
-    """删除账户"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM accounts WHERE id = ?", (account_id,))
-        await db.commit()
+# ============== 数据库 ==============
 
-async def update_account_status(account_id: int, status: str):
-    """更新账户状态"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE accounts SET status = ? WHERE id = ?", (status, account_id)
-        )
-        await db.commit()
+class JoinOutcome(IntEnum):
+    """加群结果分类 (stats.outcome 存整数代码，汇总按此分组)"""
+    SUCCESS = 0
+    FLOOD_WAIT = 1          # detail: 需等待秒数
+    ALREADY_JOINED = 2
+    INVITE_EXPIRED = 3
+    PRIVATE = 4
+    USERNAME_INVALID = 5
+    FAILED = 6              # 其他失败，error 为异常文字
+    ERROR = 7               # 任务异常，error 为异常文字
+    
+    @property
+    def status(self) -> str:
+        """对应的计数列: success / failed / error"""
+        if self is JoinOutcome.SUCCESS:
+            return "success"
+        if self is JoinOutcome.ERROR:
+            return "error"
+        return "failed"
+    
+    @property
+    def label(self) -> str:
+        return OUTCOME_LABELS[self]
+    
+    def describe(self, detail: Optional[int] = None, error: Optional[str] = None) -> str:
+        """还原给用户看的提示文字"""
+        if self is JoinOutcome.FLOOD_WAIT:
+            return f"被限制，需等待 {detail} 秒"
+        if error:
+            return error
+        return OUTCOME_MESSAGES.get(self, self.label)
 
-async def add_link(user_id: int, link: str):
-    """添加链接"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO links (user_id, link) VALUES (?, ?)", (user_id, link)
-        )
-        await db.commit()
 
-async def get_links(user_id: int) -> List[Dict]:
-    """获取用户的所有链接"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT * FROM links WHERE user_id = ?", (user_id,)
-        ) as cursor:
-            rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+OUTCOME_LABELS = {
+    JoinOutcome.SUCCESS: "成功",
+    JoinOutcome.FLOOD_WAIT: "被限制 (FloodWait)",
+    JoinOutcome.ALREADY_JOINED: "已在群里",
+    JoinOutcome.INVITE_EXPIRED: "邀请链接过期",
+    JoinOutcome.PRIVATE: "群组私有",
+    JoinOutcome.USERNAME_INVALID: "用户名不存在",
+    JoinOutcome.FAILED: "其他失败",
+    JoinOutcome.ERROR: "异常",
+}
 
-async def clear_links(user_id: int):
-    """清空链接"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM links WHERE user_id = ?", (user_id,))
-        await db.commit()
+# join_group 原有的提示文字
+OUTCOME_MESSAGES = {
+    JoinOutcome.SUCCESS: "加群成功",
+    JoinOutcome.ALREADY_JOINED: "已经在群里",
+    JoinOutcome.INVITE_EXPIRED: "邀请链接已过期",
+    JoinOutcome.PRIVATE: "群组为私有",
+    JoinOutcome.USERNAME_INVALID: "用户名不存在",
+}
 
-async def add_stat(user_id: int, account_id: int, link: str, status: str, message: str):
-    """添加统计记录"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO stats (user_id, account_id, link, status, message) VALUES (?, ?, ?, ?, ?)",
-            (user_id, account_id, link, status, message)
-        )
-        await db.commit()
 
-async def get_stats(user_id: int, limit: int = 100) -> List[Dict]:
-    """获取统计数据"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT * FROM stats WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
-            (user_id, limit)
-        ) as cursor:
-            rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+class JoinResult:
+    """一次加群尝试的结果"""
+    
+    __slots__ = ("outcome", "detail", "error")
+    
+    def __init__(self, outcome: JoinOutcome, detail: Optional[int] = None, error: Optional[str] = None):
+        self.outcome = outcome
+        self.detail = detail
+        self.error = error
+    
+    @property
+    def success(self) -> bool:
+        return self.outcome is JoinOutcome.SUCCESS
+    
+    @property
+    def status(self) -> str:
+        return self.outcome.status
+    
+    @property
+    def message(self) -> str:
+        return self.outcome.describe(self.detail, self.error)
 
-async def get_today_stats(user_id: int) -> Tuple[int, int]:
-    """获取今日统计"""
-    today = datetime.now().strftime("%Y-%m-%d")
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT COUNT(*) FROM stats WHERE user_id = ? AND date(timestamp) = ? AND status = 'success'",
-            (user_id, today)
-        ) as cursor:
-            success = (await cursor.fetchone())[0]
-        
-        async with db.execute(
-            "SELECT COUNT(*) FROM stats WHERE user_id = ? AND date(timestamp) = ? AND status = 'failed'",
-            (user_id, today)
-        ) as cursor:
-            failed = (await cursor.fetchone())[0]
-        
-        return success, failed
+# 共享数据库连接 (post_init 中创建, post_shutdown 中关闭)
+_db: Optional[aiosqlite.Connection] = None
+_db_write_lock: Optional[asyncio.Lock] = None
 
-async def get_settings(user_id: int) -> Dict:
-    """获取用户设置"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT * FROM settings WHERE user_id = ?", (user_id,)
-        ) as cursor:
-            row = await cursor.fetchone()
-            if row:
-                return dict(row)
-            else:
-                # 返回默认设置
-                return {
-                    "interval_min": 30,
-                    "interval_max": 60,
-                    "daily_limit": 50
-                }
+# 连接级 PRAGMA 调优
+DB_PRAGMAS = (
+    # 须在建表前设置才对新库生效；旧库由 init_db 转换一次
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA foreign_keys = ON",
+)
 
-async def update_settings(user_id: int, **kwargs):
-    """更新设置"""
-    # 允许的设置字段白名单及其对应的 SQL 查询
-    allowed_queries = {
-        "interval_min": "UPDATE settings SET interval_min = ? WHERE user_id = ?",
-        "interval_max": "UPDATE settings SET interval_max = ? WHERE user_id = ?",
-        "daily_limit": "UPDATE settings SET daily_limit = ? WHERE user_id = ?",
-    }
+
+async def open_db() -> aiosqlite.Connection:
+    """打开共享数据库连接并应用 PRAGMA"""
+    global _db, _db_write_lock
+    if _db is not None:
+        return _db
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        # 先尝试插入
-        await db.execute(
-            "INSERT OR IGNORE INTO settings (user_id) VALUES (?)", (user_id,)
-        )
-        
-        # 更新字段（使用预定义的查询）
-        for key, value in kwargs.items():
-            if key in allowed_queries:
-                await db.execute(allowed_queries[key], (value, user_id))
-        
-        await db.commit()
+    db = await aiosqlite.connect(DB_PATH)
+    db.row_factory = aiosqlite.Row
+    for pragma in DB_PRAGMAS:
+        await db.execute(pragma)
+    
+    _db = db
+    _db_write_lock = asyncio.Lock()
+    logger.info(f"数据库连接已打开: {DB_PATH} (WAL)")
+    return db
 
-# ============== 账户管理 ==============
 
-def is_session_file_path(session_string: str) -> bool:
-    """判断是否是 session 文件路径"""
-    if not session_string:
-        return False
-    # 检查文件是否存在（带或不带 .session 后缀）
-    if session_string.endswith('.session'):
-        return os.path.exists(session_string)
-    return os.path.exists(f"{session_string}.session")
+async def close_db():
+    """关闭共享数据库连接"""
+    global _db, _db_write_lock
+    if _db is None:
+        return
+    
+    db = _db
+    _db = None
+    _db_write_lock = None
+    try:
+        # 关闭前合并 WAL，避免遗留大 -wal 文件
+        await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    except Exception as e:
+        logger.warning(f"WAL checkpoint 失败: {e}")
+    await db.close()
+    logger.info("数据库连接已关闭")
+
+
+def get_db() -> aiosqlite.Connection:
+    """获取共享数据库连接"""
+    if _db is None:
+        raise RuntimeError("数据库尚未初始化，请先调用 open_db()")
+    return _db
+
+
+@asynccontextmanager
+async def db_transaction():
+    """写事务：串行化写入，成功提交，异常回滚"""
+    db = get_db()
+    async with _db_write_lock:
+        # 显式 BEGIN，使 DDL 也包含在事务内 (迁移需要原子性)
+        await db.execute("BEGIN")
+        try:
+            yield db
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+
+
+async def _migrate_v1_base_tables(db: aiosqlite.Connection):
+    """v1: 基础表"""
+    # 账户表
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS accounts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            phone TEXT,
+            session_string TEXT,
+            status TEXT DEFAULT 'offline',
+            added_date DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # 链接表
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS links (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            link TEXT NOT NULL,
+            added_date DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # 统计表
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            account_id INTEGER,
+            link TEXT,
+            status TEXT,
+            message TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # 设置表
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            user_id INTEGER PRIMARY KEY,
+            interval_min INTEGER DEFAULT 30,
+            interval_max INTEGER DEFAULT 60,
+            daily_limit INTEGER DEFAULT 50
+        )
+    """)
+
+
+async def _migrate_v2_stats_indexes(db: aiosqlite.Connection):
+    """v2: 统计表索引 + 按用户/按天计数表"""
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_stats_user_time ON stats(user_id, timestamp)"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_stats_user_status_time ON stats(user_id, status, timestamp)"
+    )
+    
+    # 每日计数表 (add_stat 时增量维护)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            success INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            error INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    """)
+    
+    # 用已有历史回填
+    await db.execute("""
+        INSERT OR REPLACE INTO daily_stats (user_id, day, success, failed, error)
+        SELECT user_id,
+               date(timestamp, 'localtime'),
+               SUM(status = 'success'),
+               SUM(status = 'failed'),
+               SUM(status = 'error')
+        FROM stats
+        GROUP BY user_id, date(timestamp, 'localtime')
+    """)
+
+
+async def _migrate_v3_unique_links(db: aiosqlite.Connection):
+    """v3: 链接去重 + UNIQUE(user_id, link)"""
+    await db.execute("""
+        DELETE FROM links
+        WHERE id NOT IN (SELECT MIN(id) FROM links GROUP BY user_id, link)
+    """)
+    await db.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_links_user_link ON links(user_id, link)"
+    )
+
+
+async def _migrate_v4_parsed_links(db: aiosqlite.Connection):
+    """v4: 链接预解析 (规范链接 + kind + target)"""
+    await db.execute("ALTER TABLE links ADD COLUMN kind TEXT")
+    await db.execute("ALTER TABLE links ADD COLUMN target TEXT")
+    
+    # 规范化后不同写法可能相同，先去掉唯一索引，回填后再去重重建
+    await db.execute("DROP INDEX IF EXISTS idx_links_user_link")
+    
+    last_id = 0
+    invalid_count = 0
+    while True:
+        async with db.execute(
+            "SELECT id, link FROM links WHERE id > ? ORDER BY id LIMIT 1000", (last_id,)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        
+        updates = []
+        for row in rows:
+            parsed = parse_link(row["link"])
+            if parsed is None:
+                # 保留原文并标记为无效，任务跳过，链接列表中提示用户
+                invalid_count += 1
+                updates.append((row["link"], LINK_KIND_INVALID, None, row["id"]))
+            else:
+                updates.append((*parsed, row["id"]))
+        await db.executemany(
+            "UPDATE links SET link = ?, kind = ?, target = ? WHERE id = ?", updates
+        )
+    
+    if invalid_count:
+        logger.warning(f"{invalid_count} 个链接无法解析，已标记为无效 (任务会跳过)")
+    
+    await db.execute("""
+        DELETE FROM links
+        WHERE id NOT IN (SELECT MIN(id) FROM links GROUP BY user_id, link)
+    """)
+    await db.execute(
+        "CREATE UNIQUE INDEX idx_links_user_link ON links(user_id, link)"
+    )
+
+
+async def _migrate_v5_entity_cache(db: aiosqlite.Connection):
+    """v5: 用户名解析缓存"""
+    # access_hash 只对解析它的账户有效，因此按 (账户, 用户名) 缓存
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS entity_cache (
+            account_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            peer_id INTEGER NOT NULL,
+            access_hash INTEGER NOT NULL,
+            peer_type TEXT NOT NULL,
+            resolved_at REAL NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (account_id, username)
+        ) WITHOUT ROWID
+    """)
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_entity_cache_last_used ON entity_cache(last_used)"
+    )
+
+
+async def _migrate_v6_proxy_health(db: aiosqlite.Connection):
+    """v6: 代理健康检测结果"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS proxy_health (
+            raw TEXT PRIMARY KEY,
+            ok INTEGER NOT NULL,
+            latency_ms REAL,
+            check_count INTEGER NOT NULL DEFAULT 0,
+            fail_count INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            checked_at REAL NOT NULL
+        )
+    """)
+
+
+async def _migrate_v7_task_cursors(db: aiosqlite.Connection):
+    """v7: 加群任务断点 + 成功链接索引"""
+    # 每个用户一条: 下一个要处理的链接 id、当前链接已尝试的账户、任务计数
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS task_cursors (
+            user_id INTEGER PRIMARY KEY,
+            link_id INTEGER NOT NULL,
+            tried_accounts TEXT NOT NULL DEFAULT '',
+            success INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        )
+    """)
+    # 只索引成功记录，用于跳过已成功的链接
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_stats_user_link_success "
+        "ON stats(user_id, link) WHERE status = 'success'"
+    )
+
+
+async def _migrate_v8_keyset_indexes(db: aiosqlite.Connection):
+    """v8: 分页索引 (user_id, id)"""
+    for table in ("accounts", "links", "stats"):
+        await db.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_user_id ON {table}(user_id, id)"
+        )
+
+
+async def _migrate_v9_rollups(db: aiosqlite.Connection):
+    """v9: 按小时/账户/结果分类的汇总表"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS hourly_stats (
+            user_id INTEGER NOT NULL,
+            hour TEXT NOT NULL,
+            success INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            error INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, hour)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS account_daily_stats (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            account_id INTEGER NOT NULL,
+            success INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            error INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, account_id)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS outcome_daily_stats (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            outcome TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, outcome)
+        ) WITHOUT ROWID
+    """)
+    
+    # 用已有历史回填 (旧记录按 join_group 的提示文字归类)
+    await db.execute("""
+        INSERT INTO hourly_stats (user_id, hour, success, failed, error)
+        SELECT user_id,
+               strftime('%Y-%m-%d %H', timestamp, 'localtime'),
+               SUM(status = 'success'),
+               SUM(status = 'failed'),
+               SUM(status = 'error')
+        FROM stats
+        GROUP BY 1, 2
+    """)
+    await db.execute("""
+        INSERT INTO account_daily_stats (user_id, day, account_id, success, failed, error)
+        SELECT user_id,
+               date(timestamp, 'localtime'),
+               account_id,
+               SUM(status = 'success'),
+               SUM(status = 'failed'),
+               SUM(status = 'error')
+        FROM stats
+        WHERE account_id IS NOT NULL
+        GROUP BY 1, 2, 3
+    """)
+    await db.execute("""
+        INSERT INTO outcome_daily_stats (user_id, day, outcome, count)
+        SELECT user_id,
+               date(timestamp, 'localtime'),
+               CASE
+                   WHEN status != 'failed' THEN status
+                   WHEN message LIKE '被限制%' THEN 'flood_wait'
+                   WHEN message = '已经在群里' THEN 'already_joined'
+                   WHEN message = '邀请链接已过期' THEN 'invite_expired'
+                   WHEN message = '群组为私有' THEN 'private'
+                   WHEN message = '用户名不存在' THEN 'username_invalid'
+                   ELSE 'failed'
+               END,
+               COUNT(*)
+        FROM stats
+        GROUP BY 1, 2, 3
+    """)
+
+
+async def _migrate_v10_stats_retention(db: aiosqlite.Connection):
+    """v10: 统计归档所需的时间索引 + 已成功链接表"""
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_stats_timestamp ON stats(timestamp)"
+    )
+    # stats 中的成功记录被归档后，仍通过此表跳过已成功的链接
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS succeeded_links (
+            user_id INTEGER NOT NULL,
+            link TEXT NOT NULL,
+            PRIMARY KEY (user_id, link)
+        ) WITHOUT ROWID
+    """)
+
+
+async def _migrate_v11_compact_stats(db: aiosqlite.Connection):
+    """v11: stats 改为链接引用 + 整数结果代码"""
+    # 链接和异常文字各存一份，stats 只存引用
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS link_refs (
+            link_id INTEGER PRIMARY KEY,
+            link TEXT NOT NULL UNIQUE
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS message_refs (
+            message_id INTEGER PRIMARY KEY,
+            text TEXT NOT NULL UNIQUE
+        )
+    """)
+    
+    # 旧记录按 status/提示文字归类
+    outcome_case = f"""
+        CASE
+            WHEN status = 'success' THEN {JoinOutcome.SUCCESS:d}
+            WHEN status = 'error' THEN {JoinOutcome.ERROR:d}
+            WHEN message LIKE '被限制%' THEN {JoinOutcome.FLOOD_WAIT:d}
+            WHEN message = '已经在群里' THEN {JoinOutcome.ALREADY_JOINED:d}
+            WHEN message = '邀请链接已过期' THEN {JoinOutcome.INVITE_EXPIRED:d}
+            WHEN message = '群组为私有' THEN {JoinOutcome.PRIVATE:d}
+            WHEN message = '用户名不存在' THEN {JoinOutcome.USERNAME_INVALID:d}
+            ELSE {JoinOutcome.FAILED:d}
+        END
+    """
+    free_text = f"({JoinOutcome.FAILED:d}, {JoinOutcome.ERROR:d})"
+    
+    # 旧记录中的链接是导入时的原文，按 parse_link 规范化后再入字典表，
+    # 否则 has_link_succeeded (用规范链接查询) 查不到升级前的成功记录
+    await db.execute("CREATE TEMP TABLE link_map (raw TEXT PRIMARY KEY, link TEXT NOT NULL)")
+    async with db.execute(
+        "SELECT link FROM stats WHERE link IS NOT NULL UNION SELECT link FROM succeeded_links"
+    ) as cursor:
+        raw_links = [row[0] for row in await cursor.fetchall()]
+    await db.executemany(
+        "INSERT INTO link_map (raw, link) VALUES (?, ?)",
+        [(raw, canonical_link(raw)) for raw in raw_links]
+    )
+    await db.execute("INSERT OR IGNORE INTO link_refs (link) SELECT DISTINCT link FROM link_map")
+    await db.execute(f"""
+        INSERT OR IGNORE INTO message_refs (text)
+        SELECT message FROM stats
+        WHERE message IS NOT NULL AND message != '' AND {outcome_case} IN {free_text}
+    """)
+    
+    await db.execute("""
+        CREATE TABLE stats_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            account_id INTEGER,
+            link_id INTEGER,
+            outcome INTEGER NOT NULL,
+            detail INTEGER,
+            message_id INTEGER,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await db.execute(f"""
+        INSERT INTO stats_new (id, user_id, account_id, link_id, outcome, detail, message_id, timestamp)
+        SELECT s.id, s.user_id, s.account_id, l.link_id, s.outcome,
+               CASE WHEN s.outcome = {JoinOutcome.FLOOD_WAIT:d}
+                    THEN CAST(substr(s.message, 9) AS INTEGER) END,
+               m.message_id, s.timestamp
+        FROM (SELECT *, {outcome_case} AS outcome FROM stats) s
+        LEFT JOIN link_map mp ON mp.raw = s.link
+        LEFT JOIN link_refs l ON l.link = mp.link
+        LEFT JOIN message_refs m ON m.text = s.message AND s.outcome IN {free_text}
+    """)
+    # 保留自增序号，归档文件按 id 去重依赖 id 不复用
+    await db.execute("DELETE FROM sqlite_sequence WHERE name = 'stats_new'")
+    await db.execute(
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'stats_new', seq FROM sqlite_sequence WHERE name = 'stats'"
+    )
+    await db.execute("DROP TABLE stats")
+    await db.execute("ALTER TABLE stats_new RENAME TO stats")
+    
+    await db.execute(
+        "CREATE INDEX idx_stats_user_time ON stats(user_id, timestamp)"
+    )
+    await db.execute(
+        "CREATE INDEX idx_stats_user_id ON stats(user_id, id)"
+    )
+    await db.execute(
+        "CREATE INDEX idx_stats_timestamp ON stats(timestamp)"
+    )
+    await db.execute(
+        f"CREATE INDEX idx_stats_user_link_success ON stats(user_id, link_id) "
+        f"WHERE outcome = {JoinOutcome.SUCCESS:d}"
+    )
+    
+    # 带链接和异常文字的只读视图 (日志、归档、导出使用)
+    await db.execute("""
+        CREATE VIEW stats_view AS
+        SELECT s.id, s.user_id, s.account_id, s.link_id, l.link,
+               s.outcome, s.detail, m.text AS error, s.timestamp
+        FROM stats s
+        LEFT JOIN link_refs l ON l.link_id = s.link_id
+        LEFT JOIN message_refs m ON m.message_id = s.message_id
+    """)
+    
+    # 结果汇总表和已成功链接表同样改用整数
+    await db.execute("""
+        CREATE TABLE outcome_daily_stats_new (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            outcome INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, outcome)
+        ) WITHOUT ROWID
+    """)
+    outcome_names = " ".join(
+        f"WHEN '{name}' THEN {code:d}" for name, code in (
+            ("success", JoinOutcome.SUCCESS),
+            ("flood_wait", JoinOutcome.FLOOD_WAIT),
+            ("already_joined", JoinOutcome.ALREADY_JOINED),
+            ("invite_expired", JoinOutcome.INVITE_EXPIRED),
+            ("private", JoinOutcome.PRIVATE),
+            ("username_invalid", JoinOutcome.USERNAME_INVALID),
+            ("error", JoinOutcome.ERROR),
+        )
+    )
+    await db.execute(f"""
+        INSERT INTO outcome_daily_stats_new (user_id, day, outcome, count)
+        SELECT user_id, day, CASE outcome {outcome_names} ELSE {JoinOutcome.FAILED:d} END, SUM(count)
+        FROM outcome_daily_stats
+        GROUP BY 1, 2, 3
+    """)
+    await db.execute("DROP TABLE outcome_daily_stats")
+    await db.execute("ALTER TABLE outcome_daily_stats_new RENAME TO outcome_daily_stats")
+    
+    await db.execute("""
+        CREATE TABLE succeeded_links_new (
+            user_id INTEGER NOT NULL,
+            link_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, link_id)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("""
+        INSERT OR IGNORE INTO succeeded_links_new (user_id, link_id)
+        SELECT s.user_id, l.link_id FROM succeeded_links s
+        JOIN link_map mp ON mp.raw = s.link
+        JOIN link_refs l ON l.link = mp.link
+    """)
+    await db.execute("DROP TABLE succeeded_links")
+    await db.execute("ALTER TABLE succeeded_links_new RENAME TO succeeded_links")
+    await db.execute("DROP TABLE link_map")
+
+
+async def _migrate_v12_canonical_link_refs(db: aiosqlite.Connection):
+    """v12: 合并 link_refs 中未规范化的旧链接"""
+    # 早期 v11 把升级前 stats 中的原文链接直接存入 link_refs，
+    # 这里把它们并入规范链接 (不存在则原地改写)，并改写 stats / succeeded_links 的引用
+    async with db.execute("SELECT link_id, link FROM link_refs") as cursor:
+        refs = {link: link_id for link_id, link in await cursor.fetchall()}
+    
+    merges = []
+    for link, link_id in list(refs.items()):
+        canonical = canonical_link(link)
+        if canonical == link:
+            continue
+        target_id = refs.get(canonical)
+        if target_id is None:
+            await db.execute("UPDATE link_refs SET link = ? WHERE link_id = ?", (canonical, link_id))
+            refs[canonical] = link_id
+        else:
+            merges.append((link_id, target_id))
+        del refs[link]
+    if not merges:
+        return
+    
+    await db.execute("CREATE TEMP TABLE link_merge (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)")
+    await db.executemany("INSERT INTO link_merge (old_id, new_id) VALUES (?, ?)", merges)
+    await db.execute("""
+        UPDATE stats SET link_id = (SELECT new_id FROM link_merge WHERE old_id = stats.link_id)
+        WHERE link_id IN (SELECT old_id FROM link_merge)
+    """)
+    await db.execute("""
+        INSERT OR IGNORE INTO succeeded_links (user_id, link_id)
+        SELECT s.user_id, m.new_id FROM succeeded_links s JOIN link_merge m ON m.old_id = s.link_id
+    """)
+    await db.execute("DELETE FROM succeeded_links WHERE link_id IN (SELECT old_id FROM link_merge)")
+    await db.execute("DELETE FROM link_refs WHERE link_id IN (SELECT old_id FROM link_merge)")
+    await db.execute("DROP TABLE link_merge")
+    logger.info(f"合并 {len(merges)} 个未规范化的统计链接")
+
+
+# 版本化迁移: 按顺序执行一次，当前版本记录在 PRAGMA user_version
+SCHEMA_MIGRATIONS = [
+    _migrate_v1_base_tables,
+    _migrate_v2_stats_indexes,
+    _migrate_v3_unique_links,
+    _migrate_v4_parsed_links,
+    _migrate_v5_entity_cache,
+    _migrate_v6_proxy_health,
+    _migrate_v7_task_cursors,
+    _migrate_v8_keyset_indexes,
+    _migrate_v9_rollups,
+    _migrate_v10_stats_retention,
+    _migrate_v11_compact_stats,
+    _migrate_v12_canonical_link_refs,
+]
+
+
+async def init_db():
+    """初始化数据库 (执行尚未应用的迁移)"""
+    async with get_db().execute("PRAGMA user_version") as cursor:
+        version = (await cursor.fetchone())[0]
+    
+    for target, migration in enumerate(SCHEMA_MIGRATIONS[version:], version + 1):
+        async with db_transaction() as db:
+            await migration(db)
+            await db.execute(f"PRAGMA user_version = {target}")
+        logger.info(f"数据库迁移完成: {migration.__doc__}")
+    
+    # 开启归档时，旧库需完整 VACUUM 一次才能切换为增量 VACUUM (仅首次)
+    async with get_db().execute("PRAGMA auto_vacuum") as cursor:
+        auto_vacuum = (await cursor.fetchone())[0]
+    if auto_vacuum != 2 and STATS_RETENTION_DAYS > 0:
+        logger.info("转换数据库为增量 VACUUM 模式...")
+        async with _db_write_lock:
+            await get_db().execute("PRAGMA auto_vacuum = INCREMENTAL")
+            await get_db().execute("VACUUM")
+
+async def db_incremental_vacuum(max_pages: int) -> int:
+    """回收最多 max_pages 个空闲页，返回实际回收页数"""
+    db = get_db()
+    async with _db_write_lock:
+        async with db.execute("PRAGMA freelist_count") as cursor:
+            before = (await cursor.fetchone())[0]
+        if before == 0:
+            return 0
+        # execute() 只执行一步 (回收一页)，executescript 会执行到完成
+        await db.executescript(f"PRAGMA incremental_vacuum({int(max_pages)})")
+        async with db.execute("PRAGMA freelist_count") as cursor:
+            after = (await cursor.fetchone())[0]
+    return before - after
+
+async def add_account(user_id: int, phone: str, session_string: str) -> int:
+    """添加账户"""
+    async with db_transaction() as db:
+        cursor = await db.execute(
+            "INSERT INTO accounts (user_id, phone, session_string) VALUES (?, ?, ?)",
+            (user_id, phone, session_string)
+        )
+        return cursor.lastrowid
+
+async def get_accounts(user_id: int) -> List[Dict]:
+    """获取用户的所有账户"""
+    async with get_db().execute(
+        "SELECT * FROM accounts WHERE user_id = ?", (user_id,)
+    ) as cursor:
+        rows = await cursor.fetchall()
+        return [dict(row) for row in rows]
+
+async def delete_account(account_id: int):
+    """删除账户"""
+    async with db_transaction() as db:
+        await db.execute("DELETE FROM accounts WHERE id = ?", (account_id,))
+
+async def update_account_status(account_id: int, status: str):
+    """更新账户状态"""
+    async with db_transaction() as db:
+        await db.execute(
+            "UPDATE accounts SET status = ? WHERE id = ?", (status, account_id)
+        )
+
+async def apply_account_status_batch(status_updates: List[Tuple[str, int]], deleted_ids: List[int]):
+    """批量更新账户状态并删除账户 (单个事务)
+    status_updates: [(status, account_id), ...]
+    """
+    async with db_transaction() as db:
+        if status_updates:
+            await db.executemany(
+                "UPDATE accounts SET status = ? WHERE id = ?", status_updates
+            )
+        if deleted_ids:
+            await db.executemany(
+                "DELETE FROM accounts WHERE id = ?", [(i,) for i in deleted_ids]
+            )
+
+async def add_accounts_batch(user_id: int, accounts: List[Tuple[str, str]]):
+    """批量添加账户 (单个事务)
+    accounts: [(phone, session_string), ...]
+    """
+    async with db_transaction() as db:
+        await db.executemany(
+            "INSERT INTO accounts (user_id, phone, session_string) VALUES (?, ?, ?)",
+            [(user_id, phone, session_string) for phone, session_string in accounts]
+        )
+
+async def fetch_page(table: str, columns: str, user_id: int, limit: int,
+                     after_id: Optional[int] = None, before_id: Optional[int] = None,
+                     newest_first: bool = False) -> Tuple[List[Dict], int, bool, bool]:
+    """按 (user_id, id) 索引做 keyset 分页，只查询 columns 列
+    after_id: 翻到下一页 (显示顺序中该 id 之后)；before_id: 翻到上一页
+    返回 (rows, 本页之前的条数, 是否有上一页, 是否有下一页)
+    """
+    # 显示顺序为正向；翻上一页时反向查询再倒序
+    forward_cmp, forward_order = ("<", "DESC") if newest_first else (">", "ASC")
+    backward_cmp, backward_order = (">", "ASC") if newest_first else ("<", "DESC")
+    
+    if before_id is not None:
+        sql = (f"SELECT {columns} FROM {table} WHERE user_id = ? AND id {backward_cmp} ? "
+               f"ORDER BY id {backward_order} LIMIT ?")
+        params = (user_id, before_id, limit + 1)
+    elif after_id is not None:
+        sql = (f"SELECT {columns} FROM {table} WHERE user_id = ? AND id {forward_cmp} ? "
+               f"ORDER BY id {forward_order} LIMIT ?")
+        params = (user_id, after_id, limit + 1)
+    else:
+        sql = f"SELECT {columns} FROM {table} WHERE user_id = ? ORDER BY id {forward_order} LIMIT ?"
+        params = (user_id, limit + 1)
+    
+    async with get_db().execute(sql, params) as cursor:
+        rows = [dict(row) for row in await cursor.fetchall()]
+    more = len(rows) > limit
+    rows = rows[:limit]
+    
+    if before_id is not None:
+        rows.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = after_id is not None, more
+    
+    offset = 0
+    if rows:
+        async with get_db().execute(
+            f"SELECT COUNT(*) FROM {table} WHERE user_id = ? AND id {backward_cmp} ?",
+            (user_id, rows[0]["id"])
+        ) as cursor:
+            offset = (await cursor.fetchone())[0]
+        has_prev = offset > 0
+    return rows, offset, has_prev, has_next
+
+async def count_rows(table: str, user_id: int) -> int:
+    """用户在表中的记录数 (走 (user_id, id) 索引)"""
+    async with get_db().execute(
+        f"SELECT COUNT(*) FROM {table} WHERE user_id = ?", (user_id,)
+    ) as cursor:
+        return (await cursor.fetchone())[0]
+
+async def add_link(user_id: int, parsed: Tuple[str, str, str]) -> bool:
+    """添加链接 (parse_link 的结果)，返回是否为新链接 (重复链接忽略)"""
+    return await add_links_batch(user_id, [parsed]) > 0
+
+async def add_links_batch(user_id: int, links: List[Tuple[str, str, str]]) -> int:
+    """批量添加已解析的链接 (单个事务)，返回实际新增数量"""
+    async with db_transaction() as db:
+        before = db.total_changes
+        await db.executemany(
+            "INSERT OR IGNORE INTO links (user_id, link, kind, target) VALUES (?, ?, ?, ?)",
+            [(user_id, link, kind, target) for link, kind, target in links]
+        )
+        return db.total_changes - before
+
+async def get_link_range(user_id: int, start_id: int = 0) -> Tuple[int, Optional[int]]:
+    """从指定 id 开始的有效链接数和最大 id (走 (user_id, id) 索引)"""
+    async with get_db().execute(
+        "SELECT COUNT(*), MAX(id) FROM links WHERE user_id = ? AND id >= ? AND kind != ?",
+        (user_id, start_id, LINK_KIND_INVALID)
+    ) as cursor:
+        count, max_id = await cursor.fetchone()
+    return count, max_id
+
+async def iter_links(user_id: int, start_id: int = 0, end_id: Optional[int] = None,
+                     chunk_size: int = TASK_LINK_CHUNK) -> AsyncIterator[Dict]:
+    """按 id 顺序逐批读取有效链接 [start_id, end_id] (跳过标记为无效的链接)
+    每批用 keyset 条件单独查询，批与批之间不占用游标，内存只保留一批
+    """
+    last_id = start_id - 1
+    while True:
+        if end_id is None:
+            sql, params = (
+                "SELECT * FROM links WHERE user_id = ? AND id > ? AND kind != ? ORDER BY id LIMIT ?",
+                (user_id, last_id, LINK_KIND_INVALID, chunk_size),
+            )
+        else:
+            sql, params = (
+                "SELECT * FROM links WHERE user_id = ? AND id > ? AND id <= ? AND kind != ? ORDER BY id LIMIT ?",
+                (user_id, last_id, end_id, LINK_KIND_INVALID, chunk_size),
+            )
+        async with get_db().execute(sql, params) as cursor:
+            rows = await cursor.fetchall()
+        for row in rows:
+            yield dict(row)
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1]["id"]
+
+async def clear_links(user_id: int):
+    """清空链接"""
+    async with db_transaction() as db:
+        await db.execute("DELETE FROM links WHERE user_id = ?", (user_id,))
+        await db.execute("DELETE FROM task_cursors WHERE user_id = ?", (user_id,))
+
+def _status_counter_upserts(table: str, keys: Tuple[str, ...]) -> Dict[str, str]:
+    """按状态列累加的 UPSERT 语句，参数: (*keys, 增量)"""
+    columns = ", ".join(keys)
+    placeholders = ", ".join("?" * (len(keys) + 1))
+    return {
+        status: (
+            f"INSERT INTO {table} ({columns}, {status}) VALUES ({placeholders}) "
+            f"ON CONFLICT({columns}) DO UPDATE SET {status} = {status} + excluded.{status}"
+        )
+        for status in ("success", "failed", "error")
+    }
+
+# 计数汇总 UPSERT (按状态)
+DAILY_STAT_UPSERTS = _status_counter_upserts("daily_stats", ("user_id", "day"))
+HOURLY_STAT_UPSERTS = _status_counter_upserts("hourly_stats", ("user_id", "hour"))
+ACCOUNT_STAT_UPSERTS = _status_counter_upserts("account_daily_stats", ("user_id", "day", "account_id"))
+OUTCOME_STAT_UPSERT = (
+    "INSERT INTO outcome_daily_stats (user_id, day, outcome, count) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(user_id, day, outcome) DO UPDATE SET count = count + excluded.count"
+)
+TASK_CURSOR_UPSERT = (
+    "INSERT OR REPLACE INTO task_cursors "
+    "(user_id, link_id, tried_accounts, success, failed, updated_at) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+
+async def intern_refs(db: aiosqlite.Connection, table: str, id_column: str, value_column: str, values) -> Dict[str, int]:
+    """把字符串存入字典表 (link_refs / message_refs)，返回 {值: id}"""
+    values = list(values)
+    if not values:
+        return {}
+    await db.executemany(
+        f"INSERT OR IGNORE INTO {table} ({value_column}) VALUES (?)", [(v,) for v in values]
+    )
+    ids = {}
+    for start in range(0, len(values), REF_LOOKUP_CHUNK):
+        chunk = values[start:start + REF_LOOKUP_CHUNK]
+        async with db.execute(
+            f"SELECT {id_column}, {value_column} FROM {table} "
+            f"WHERE {value_column} IN ({', '.join('?' * len(chunk))})",
+            chunk
+        ) as cursor:
+            for row in await cursor.fetchall():
+                ids[row[1]] = row[0]
+    return ids
+
+
+class StatsWriter:
+    """统计记录后台批量写入 (write-behind)
+    
+    add_stat 只把记录放进队列；后台任务在条数达到 batch_size 或
+    缓冲超过 interval 秒时，用一个事务批量写入 stats 并更新各汇总表
+    (daily_stats / hourly_stats / account_daily_stats / outcome_daily_stats)。
+    任务断点 (set_cursor) 随同一事务写入，断点不会超前于已落盘的统计。
+    """
+    
+    def __init__(self, batch_size: int, interval: float, maxsize: int):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.maxsize = maxsize
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending: List[Tuple] = []
+        self._cursors: Dict[int, Tuple] = {}
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: Optional[asyncio.Future] = None
+        self._backpressure_warned = False
+        self.dropped = 0
+    
+    @property
+    def depth(self) -> int:
+        """尚未落盘的记录数 (队列 + 当前批次)"""
+        queued = self._queue.qsize() if self._queue else 0
+        return queued + len(self._pending)
+    
+    def start(self):
+        """启动后台写入任务"""
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run(), name="stats-writer")
+    
+    async def put(self, record: Tuple):
+        """加入一条记录；队列满时等待 (背压)"""
+        if self._queue is None:
+            raise RuntimeError("StatsWriter 尚未启动")
+        
+        depth = self.depth
+        if depth >= STATS_QUEUE_WARN_DEPTH and not self._backpressure_warned:
+            logger.warning(f"统计写入队列积压: {depth} 条")
+            self._backpressure_warned = True
+        elif depth < STATS_QUEUE_WARN_DEPTH // 2:
+            self._backpressure_warned = False
+        
+        await self._queue.put(record)
+    
+    def set_cursor(self, user_id: int, row: Tuple):
+        """登记任务断点 (只保留每个用户最新的一个)，随下一批统计写入"""
+        self._cursors[user_id] = row
+    
+    async def flush(self):
+        """立即写入所有已排队的记录和断点"""
+        if self._queue is None:
+            return
+        stop_requested = False
+        while not self._queue.empty():
+            record = self._queue.get_nowait()
+            if record is None:
+                stop_requested = True
+            else:
+                self._pending.append(record)
+        if stop_requested:
+            # 停止标记留给后台任务处理
+            self._queue.put_nowait(None)
+        await self._write_pending()
+    
+    async def stop(self):
+        """停止后台任务并写入剩余记录"""
+        if self._task is None:
+            return
+        # 用 None 作为停止标记，而不是 cancel()，避免打断正在进行的批量写入
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        await self.flush()
+    
+    async def _run(self):
+        """后台循环：按条数或时间阈值批量写入"""
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            record = await self._queue.get()
+            if record is None:
+                break
+            self._pending.append(record)
+            deadline = loop.time() + self.interval
+            
+            while len(self._pending) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                self._pending.append(record)
+            
+            await self._write_pending()
+    
+    async def _write_pending(self):
+        """把当前批次写入数据库 (单个事务)"""
+        async with self._flush_lock:
+            if self._inflight is not None:
+                # 上一次写入的调用方已被取消，先等它的事务结束
+                await asyncio.shield(self._inflight)
+                self._inflight = None
+            batch, self._pending = self._pending, []
+            cursors, self._cursors = self._cursors, {}
+            if not batch and not cursors:
+                return
+            # shield: 调用方被取消 (如停止任务) 时事务照常提交或回滚后放回，批次不会丢失
+            self._inflight = asyncio.ensure_future(self._commit(batch, cursors))
+            try:
+                await asyncio.shield(self._inflight)
+            finally:
+                if self._inflight.done():
+                    self._inflight = None
+    
+    async def _commit(self, batch: List[Tuple], cursors: Dict[int, Tuple]):
+        """合并汇总计数并在一个事务内写入 (连同断点)；失败时放回队首"""
+        # 先在内存中按汇总表的键合并计数
+        daily: Dict[Tuple, int] = {}
+        hourly: Dict[Tuple, int] = {}
+        per_account: Dict[Tuple, int] = {}
+        per_outcome: Dict[Tuple, int] = {}
+        for user_id, account_id, _, outcome, _, _, day, hour, _ in batch:
+            key = (user_id, day, outcome)
+            per_outcome[key] = per_outcome.get(key, 0) + 1
+            status = JoinOutcome(outcome).status
+            key = (status, user_id, day)
+            daily[key] = daily.get(key, 0) + 1
+            key = (status, user_id, hour)
+            hourly[key] = hourly.get(key, 0) + 1
+            if account_id is not None:
+                key = (status, user_id, day, account_id)
+                per_account[key] = per_account.get(key, 0) + 1
+        
+        try:
+            async with db_transaction() as db:
+                # 链接和异常文字存入字典表，stats 只存引用
+                link_ids = await intern_refs(
+                    db, "link_refs", "link_id", "link", {r[2] for r in batch if r[2]}
+                )
+                message_ids = await intern_refs(
+                    db, "message_refs", "message_id", "text", {r[5] for r in batch if r[5]}
+                )
+                await db.executemany(
+                    "INSERT INTO stats (user_id, account_id, link_id, outcome, detail, message_id, timestamp) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (u, a, link_ids.get(l), o, d, message_ids.get(e), ts)
+                        for u, a, l, o, d, e, _, _, ts in batch
+                    ]
+                )
+                
+                # 增量维护汇总表
+                for upserts, counters in (
+                    (DAILY_STAT_UPSERTS, daily),
+                    (HOURLY_STAT_UPSERTS, hourly),
+                    (ACCOUNT_STAT_UPSERTS, per_account),
+                ):
+                    for (status, *keys), count in counters.items():
+                        await db.execute(upserts[status], (*keys, count))
+                await db.executemany(
+                    OUTCOME_STAT_UPSERT,
+                    [(*keys, count) for keys, count in per_outcome.items()]
+                )
+                await db.executemany(TASK_CURSOR_UPSERT, cursors.values())
+        except Exception as e:
+            # 写入失败时放回队首，下个周期重试 (期间登记的新断点优先)
+            logger.error(f"批量写入统计失败 ({len(batch)} 条): {e}")
+            self._pending[:0] = batch
+            for user_id, row in cursors.items():
+                self._cursors.setdefault(user_id, row)
+            excess = len(self._pending) - STATS_PENDING_MAX
+            if excess > 0:
+                # 数据库持续不可写时限制内存占用，丢弃最旧的记录
+                del self._pending[:excess]
+                self.dropped += excess
+                logger.error(f"统计写入持续失败，丢弃最旧的 {excess} 条记录 (累计 {self.dropped} 条)")
+
+
+stats_writer = StatsWriter(STATS_FLUSH_BATCH_SIZE, STATS_FLUSH_INTERVAL, STATS_QUEUE_MAXSIZE)
+
+
+async def add_stat(user_id: int, account_id: int, link: str, result: JoinResult):
+    """添加统计记录 (经 stats_writer 批量写入)"""
+    now = datetime.now()
+    await stats_writer.put((
+        user_id,
+        account_id,
+        link,
+        int(result.outcome),
+        result.detail,
+        result.error,
+        now.strftime("%Y-%m-%d"),
+        now.strftime("%Y-%m-%d %H"),
+        # 与 CURRENT_TIMESTAMP 一致的 UTC 格式
+        now.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+    ))
+
+
+def describe_stat_row(row) -> Dict:
+    """stats_view 的一行转为带 status/message 文字的字典"""
+    data = dict(row)
+    outcome = JoinOutcome(data["outcome"])
+    data["status"] = outcome.status
+    data["message"] = outcome.describe(data["detail"], data["error"])
+    return data
+
+async def get_today_stats(user_id: int) -> Tuple[int, int]:
+    """获取今日统计"""
+    today = datetime.now().strftime("%Y-%m-%d")
+    async with get_db().execute(
+        "SELECT success, failed FROM daily_stats WHERE user_id = ? AND day = ?",
+        (user_id, today)
+    ) as cursor:
+        row = await cursor.fetchone()
+    
+    if not row:
+        return 0, 0
+    return row["success"], row["failed"]
+
+async def has_link_succeeded(user_id: int, link: str) -> bool:
+    """链接是否已有成功记录 (stats 走 idx_stats_user_link_success 部分索引，
+    已归档的成功记录在 succeeded_links 中)"""
+    async with get_db().execute(
+        "SELECT link_id FROM link_refs WHERE link = ?", (link,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        return False
+    
+    link_id = row[0]
+    async with get_db().execute(
+        f"SELECT EXISTS (SELECT 1 FROM stats WHERE user_id = ? AND link_id = ? AND outcome = {JoinOutcome.SUCCESS:d}) "
+        "OR EXISTS (SELECT 1 FROM succeeded_links WHERE user_id = ? AND link_id = ?)",
+        (user_id, link_id, user_id, link_id)
+    ) as cursor:
+        return bool((await cursor.fetchone())[0])
+
+async def get_task_cursor(user_id: int) -> Optional[Dict]:
+    """读取任务断点，tried_accounts 解析为账户 id 集合"""
+    async with get_db().execute(
+        "SELECT link_id, tried_accounts, success, failed FROM task_cursors WHERE user_id = ?",
+        (user_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    
+    if not row:
+        return None
+    cursor_data = dict(row)
+    cursor_data["tried_accounts"] = {
+        int(i) for i in row["tried_accounts"].split(",") if i
+    }
+    return cursor_data
+
+def save_task_cursor(user_id: int, link_id: int, tried_accounts: List[int], success: int, failed: int):
+    """保存任务断点 (经 stats_writer 与统计记录在同一事务中写入，不单独提交)"""
+    stats_writer.set_cursor(user_id, (
+        user_id, link_id, ",".join(map(str, tried_accounts)), success, failed, time.time()
+    ))
+
+async def clear_task_cursor(user_id: int):
+    """任务跑完全部链接后删除断点"""
+    async with db_transaction() as db:
+        await db.execute("DELETE FROM task_cursors WHERE user_id = ?", (user_id,))
+
+async def get_stats_dashboard(user_id: int, days: int) -> Dict:
+    """统计面板数据，只读汇总表 (行数只与天数/账户数相关，与尝试次数无关)"""
+    now = datetime.now()
+    since = (now - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    db = get_db()
+    
+    async with db.execute(
+        "SELECT day, success, failed, error FROM daily_stats "
+        "WHERE user_id = ? AND day >= ? ORDER BY day",
+        (user_id, since)
+    ) as cursor:
+        daily = [dict(row) for row in await cursor.fetchall()]
+    
+    async with db.execute(
+        "SELECT hour, success, failed, error FROM hourly_stats "
+        "WHERE user_id = ? AND hour >= ? ORDER BY hour",
+        (user_id, now.strftime("%Y-%m-%d 00"))
+    ) as cursor:
+        hourly = [dict(row) for row in await cursor.fetchall()]
+    
+    async with db.execute(
+        "SELECT s.account_id, a.phone, SUM(s.success) AS success, "
+        "SUM(s.failed) AS failed, SUM(s.error) AS error "
+        "FROM account_daily_stats s LEFT JOIN accounts a ON a.id = s.account_id "
+        "WHERE s.user_id = ? AND s.day >= ? "
+        "GROUP BY s.account_id ORDER BY success DESC, failed ASC LIMIT ?",
+        (user_id, since, DASHBOARD_TOP_ACCOUNTS)
+    ) as cursor:
+        accounts = [dict(row) for row in await cursor.fetchall()]
+    
+    async with db.execute(
+        "SELECT outcome, SUM(count) AS count FROM outcome_daily_stats "
+        "WHERE user_id = ? AND day >= ? AND outcome != ? "
+        "GROUP BY outcome ORDER BY count DESC",
+        (user_id, since, int(JoinOutcome.SUCCESS))
+    ) as cursor:
+        outcomes = [dict(row) for row in await cursor.fetchall()]
+    
+    return {"daily": daily, "hourly": hourly, "accounts": accounts, "outcomes": outcomes}
+
+async def get_cached_entity(account_id: int, username: str) -> Optional[Dict]:
+    """读取未过期的用户名解析结果
+    最近使用时间只用于容量淘汰，不需要精确: 距上次写回超过 ENTITY_CACHE_TOUCH_INTERVAL 才更新，
+    大多数命中不产生写事务
+    """
+    now = time.time()
+    async with get_db().execute(
+        "SELECT peer_id, access_hash, peer_type, last_used FROM entity_cache "
+        "WHERE account_id = ? AND username = ? AND resolved_at > ?",
+        (account_id, username, now - ENTITY_CACHE_TTL)
+    ) as cursor:
+        row = await cursor.fetchone()
+    
+    if not row:
+        return None
+    if now - row["last_used"] >= ENTITY_CACHE_TOUCH_INTERVAL:
+        async with db_transaction() as db:
+            await db.execute(
+                "UPDATE entity_cache SET last_used = ? WHERE account_id = ? AND username = ?",
+                (now, account_id, username)
+            )
+    return {"peer_id": row["peer_id"], "access_hash": row["access_hash"], "peer_type": row["peer_type"]}
+
+# 上次容量检查后新增的条目数
+_entity_cache_inserts = 0
+
+async def put_cached_entity(account_id: int, username: str, peer_id: int, access_hash: int, peer_type: str):
+    """保存用户名解析结果，每新增 ENTITY_CACHE_EVICT_EVERY 条检查一次容量"""
+    global _entity_cache_inserts
+    now = time.time()
+    async with db_transaction() as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO entity_cache "
+            "(account_id, username, peer_id, access_hash, peer_type, resolved_at, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (account_id, username, peer_id, access_hash, peer_type, now, now)
+        )
+    
+    _entity_cache_inserts += 1
+    if _entity_cache_inserts >= ENTITY_CACHE_EVICT_EVERY:
+        _entity_cache_inserts = 0
+        await evict_entity_cache(ENTITY_CACHE_MAX_ENTRIES)
+
+async def evict_entity_cache(max_entries: int) -> int:
+    """超出容量时按最近使用时间淘汰多出的条目 (从 last_used 索引头部删除)，返回删除数"""
+    async with get_db().execute("SELECT COUNT(*) FROM entity_cache") as cursor:
+        excess = (await cursor.fetchone())[0] - max_entries
+    if excess <= 0:
+        return 0
+    async with db_transaction() as db:
+        await db.execute(
+            "DELETE FROM entity_cache WHERE (account_id, username) IN ("
+            "SELECT account_id, username FROM entity_cache ORDER BY last_used LIMIT ?)",
+            (excess,)
+        )
+    return excess
+
+async def drop_cached_entity(account_id: int, username: str):
+    """删除失效的解析结果"""
+    async with db_transaction() as db:
+        await db.execute(
+            "DELETE FROM entity_cache WHERE account_id = ? AND username = ?",
+            (account_id, username)
+        )
+
+async def save_proxy_health(results: List[Tuple[str, bool, Optional[float], Optional[str]]]):
+    """批量保存代理检测结果 (raw, 是否可用, 耗时毫秒, 错误)"""
+    now = time.time()
+    async with db_transaction() as db:
+        await db.executemany(
+            """
+            INSERT INTO proxy_health (raw, ok, latency_ms, check_count, fail_count, last_error, checked_at)
+            VALUES (?, ?, ?, 1, ?, ?, ?)
+            ON CONFLICT(raw) DO UPDATE SET
+                ok = excluded.ok,
+                latency_ms = excluded.latency_ms,
+                check_count = check_count + 1,
+                fail_count = fail_count + excluded.fail_count,
+                last_error = excluded.last_error,
+                checked_at = excluded.checked_at
+            """,
+            [
+                (raw, int(ok), latency_ms, 0 if ok else 1, error, now)
+                for raw, ok, latency_ms, error in results
+            ]
+        )
+
+async def get_proxy_health() -> Dict[str, Dict]:
+    """读取所有代理的最近检测结果，按 raw 索引"""
+    async with get_db().execute("SELECT * FROM proxy_health") as cursor:
+        rows = await cursor.fetchall()
+        return {row["raw"]: dict(row) for row in rows}
+
+async def get_dead_proxies() -> List[str]:
+    """最近一次检测失败的代理"""
+    async with get_db().execute("SELECT raw FROM proxy_health WHERE ok = 0") as cursor:
+        return [row[0] for row in await cursor.fetchall()]
+
+class SettingsCache:
+    """用户设置的进程内缓存 (update_settings 写入时同步更新)
+    
+    按最近访问排序，超过 max_size 淘汰最久未访问的用户，
+    空闲超过 idle_ttl 秒的条目在下次访问缓存时清理。
+    """
+    
+    def __init__(self, max_size: int, idle_ttl: float):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._entries: "OrderedDict[int, Tuple[Dict, float]]" = OrderedDict()
+    
+    def get(self, user_id: int) -> Optional[Dict]:
+        self._evict_idle()
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        self._entries[user_id] = (entry[0], time.monotonic())
+        self._entries.move_to_end(user_id)
+        return dict(entry[0])
+    
+    def put(self, user_id: int, settings: Dict):
+        self._entries[user_id] = (dict(settings), time.monotonic())
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    def _evict_idle(self):
+        deadline = time.monotonic() - self.idle_ttl
+        while self._entries:
+            user_id, (_, last_used) = next(iter(self._entries.items()))
+            if last_used >= deadline:
+                break
+            del self._entries[user_id]
+
+
+settings_cache = SettingsCache(SETTINGS_CACHE_MAX_USERS, SETTINGS_CACHE_IDLE_TTL)
+
+
+async def get_settings(user_id: int) -> Dict:
+    """获取用户设置 (优先读缓存)"""
+    settings = settings_cache.get(user_id)
+    if settings is not None:
+        return settings
+    
+    async with get_db().execute(
+        "SELECT interval_min, interval_max, daily_limit FROM settings WHERE user_id = ?", (user_id,)
+    ) as cursor:
+        row = await cursor.fetchone()
+        if row:
+            settings = dict(row)
+        else:
+            # 返回默认设置
+            settings = {
+                "interval_min": 30,
+                "interval_max": 60,
+                "daily_limit": 50
+            }
+    settings_cache.put(user_id, settings)
+    return settings
+
+async def update_settings(user_id: int, **kwargs):
+    """更新设置"""
+    # 允许的设置字段白名单及其对应的 SQL 查询
+    allowed_queries = {
+        "interval_min": "UPDATE settings SET interval_min = ? WHERE user_id = ?",
+        "interval_max": "UPDATE settings SET interval_max = ? WHERE user_id = ?",
+        "daily_limit": "UPDATE settings SET daily_limit = ? WHERE user_id = ?",
+    }
+    
+    async with db_transaction() as db:
+        # 先尝试插入
+        await db.execute(
+            "INSERT OR IGNORE INTO settings (user_id) VALUES (?)", (user_id,)
+        )
+        
+        # 更新字段（使用预定义的查询）
+        for key, value in kwargs.items():
+            if key in allowed_queries:
+                await db.execute(allowed_queries[key], (value, user_id))
+        
+        # 在同一事务内读回写入后的值
+        async with db.execute(
+            "SELECT interval_min, interval_max, daily_limit FROM settings WHERE user_id = ?", (user_id,)
+        ) as cursor:
+            settings = dict(await cursor.fetchone())
+    
+    # 提交成功后再更新缓存
+    settings_cache.put(user_id, settings)
+
+# ============== 统计归档 ==============
+
+def get_archive_path(day: str) -> str:
+    """某天 (本地日期) 的归档文件"""
+    return os.path.join(ARCHIVE_DIR, f"stats-{day}.jsonl.gz")
+
+def utc_to_local_day(timestamp: str) -> str:
+    """stats.timestamp (UTC) 转本地日期"""
+    utc_time = datetime.strptime(timestamp[:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    return utc_time.astimezone().strftime("%Y-%m-%d")
+
+def append_archive_rows(rows: List[Dict]):
+    """按本地日期追加写入 gzip JSONL (在线程中执行)
+    每次追加是一个独立的 gzip member，gzip.open 可以连续读取
+    """
+    by_day: Dict[str, List[Dict]] = {}
+    for row in rows:
+        by_day.setdefault(utc_to_local_day(row["timestamp"]), []).append(row)
+    
+    for day, day_rows in by_day.items():
+        with gzip.open(get_archive_path(day), "at", encoding="utf-8") as f:
+            for row in day_rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+def iter_archive_rows(user_id: Optional[int] = None) -> Iterator[Dict]:
+    """按日期顺序读取归档记录 (阻塞，应在线程中迭代)
+    归档后删除前若中断，下次会重复归档同一批记录，这里按 id 去重
+    """
+    for name in sorted(os.listdir(ARCHIVE_DIR)):
+        if not (name.startswith("stats-") and name.endswith(".jsonl.gz")):
+            continue
+        seen = set()
+        with gzip.open(os.path.join(ARCHIVE_DIR, name), "rt", encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                if row["id"] in seen or (user_id is not None and row["user_id"] != user_id):
+                    continue
+                seen.add(row["id"])
+                yield row
+
+
+async def archive_old_stats(retention_days: int) -> int:
+    """把超过保留期的 stats 记录移到归档文件，返回归档条数
+    分批进行，每批: 线程中写文件 -> 短事务删除，期间不阻塞事件循环和实时写入
+    """
+    cutoff_local = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=retention_days)
+    cutoff = cutoff_local.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    archived = 0
+    
+    while True:
+        async with get_db().execute(
+            "SELECT * FROM stats_view WHERE timestamp < ? ORDER BY timestamp, id LIMIT ?",
+            (cutoff, STATS_ARCHIVE_BATCH_SIZE)
+        ) as cursor:
+            rows = [describe_stat_row(row) for row in await cursor.fetchall()]
+        if not rows:
+            break
+        
+        # 归档文件自成一体: 保存链接和提示文字，不依赖数据库中的字典表
+        await asyncio.to_thread(append_archive_rows, [
+            {
+                "id": row["id"],
+                "user_id": row["user_id"],
+                "account_id": row["account_id"],
+                "link": row["link"],
+                "outcome": row["outcome"],
+                "status": row["status"],
+                "message": row["message"],
+                "timestamp": row["timestamp"],
+            }
+            for row in rows
+        ])
+        
+        async with db_transaction() as db:
+            # 成功记录另存一份，归档后仍能跳过已成功的链接
+            await db.executemany(
+                "INSERT OR IGNORE INTO succeeded_links (user_id, link_id) VALUES (?, ?)",
+                [(row["user_id"], row["link_id"]) for row in rows if row["outcome"] == JoinOutcome.SUCCESS]
+            )
+            await db.executemany(
+                "DELETE FROM stats WHERE id = ?", [(row["id"],) for row in rows]
+            )
+        archived += len(rows)
+        await asyncio.sleep(0)
+    
+    if archived:
+        # 汇总表只保留当日明细所需的小时数据
+        async with db_transaction() as db:
+            await db.execute(
+                "DELETE FROM hourly_stats WHERE hour < ?", (cutoff_local.strftime("%Y-%m-%d %H"),)
+            )
+    return archived
+
+
+async def prune_stat_refs() -> Tuple[int, int]:
+    """删除不再被引用的链接/提示文字 (归档删除 stats 后调用)
+    链接仍在 succeeded_links 中的保留；返回 (删除的链接数, 删除的文字数)
+    """
+    async with db_transaction() as db:
+        # 非关联子查询只物化一次，整体为一次 stats 扫描；排除 NULL 以免 NOT IN 恒为假
+        cursor = await db.execute("""
+            DELETE FROM link_refs
+            WHERE link_id NOT IN (SELECT link_id FROM stats WHERE link_id IS NOT NULL)
+              AND link_id NOT IN (SELECT link_id FROM succeeded_links)
+        """)
+        links = cursor.rowcount
+        cursor = await db.execute("""
+            DELETE FROM message_refs
+            WHERE message_id NOT IN (SELECT message_id FROM stats WHERE message_id IS NOT NULL)
+        """)
+        messages = cursor.rowcount
+    return links, messages
+
+
+class StatsArchiver:
+    """定期归档旧统计并增量回收空间的后台任务"""
+    
+    def __init__(self, retention_days: int, interval: float):
+        self.retention_days = retention_days
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self._stop_event: Optional[asyncio.Event] = None
+    
+    def start(self):
+        if self._task is not None or self.retention_days <= 0:
+            return
+        self._stop_event = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="stats-archiver")
+    
+    async def stop(self):
+        """等待当前批次完成后停止"""
+        if self._task is None:
+            return
+        self._stop_event.set()
+        await self._task
+        self._task = None
+    
+    async def run_once(self):
+        archived = await archive_old_stats(self.retention_days)
+        if archived:
+            logger.info(f"已归档 {archived} 条统计记录 (保留 {self.retention_days} 天)")
+            links, messages = await prune_stat_refs()
+            if links or messages:
+                logger.info(f"清理无引用的链接 {links} 条、提示文字 {messages} 条")
+        
+        # 分步增量 VACUUM，每步之间让出写锁
+        freed = 0
+        while not self._stop_event.is_set():
+            pages = await db_incremental_vacuum(INCREMENTAL_VACUUM_PAGES)
+            if pages == 0:
+                break
+            freed += pages
+            await asyncio.sleep(INCREMENTAL_VACUUM_PAUSE)
+        if freed:
+            logger.info(f"增量 VACUUM 回收 {freed} 页")
+    
+    async def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"统计归档失败: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+stats_archiver = StatsArchiver(STATS_RETENTION_DAYS, STATS_ARCHIVE_INTERVAL)
+
+
+async def export_user_stats(user_id: int, dest_path: str) -> int:
+    """导出用户全部统计 (归档 + 数据库) 为 ZIP 内的 CSV，返回条数
+    创建、写入和收尾 ZIP 都在线程中进行
+    """
+    def open_export():
+        zf = zipfile.ZipFile(dest_path, "w", zipfile.ZIP_DEFLATED)
+        raw = zf.open(f"stats_{user_id}.csv", "w")
+        f = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+        writer = csv.writer(f)
+        writer.writerow(["id", "时间(UTC)", "账户ID", "链接", "结果", "信息"])
+        return zf, raw, f, writer
+    
+    def close_export():
+        f.flush()
+        f.detach()
+        raw.close()
+        zf.close()
+    
+    def write_archived() -> int:
+        count = 0
+        for row in iter_archive_rows(user_id):
+            writer.writerow([row["id"], row["timestamp"], row["account_id"], row["link"], row["status"], row["message"]])
+            count += 1
+        return count
+    
+    zf, raw, f, writer = await asyncio.to_thread(open_export)
+    try:
+        total = await asyncio.to_thread(write_archived)
+        
+        # 数据库中的记录按 id 分批读取
+        last_id = 0
+        while True:
+            async with get_db().execute(
+                "SELECT * FROM stats_view WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?",
+                (user_id, last_id, STATS_ARCHIVE_BATCH_SIZE)
+            ) as cursor:
+                rows = [describe_stat_row(row) for row in await cursor.fetchall()]
+            if not rows:
+                break
+            await asyncio.to_thread(writer.writerows, [
+                (row["id"], row["timestamp"], row["account_id"], row["link"], row["status"], row["message"])
+                for row in rows
+            ])
+            total += len(rows)
+            last_id = rows[-1]["id"]
+    finally:
+        await asyncio.to_thread(close_export)
+    return total
+
+
+def make_temp_file(suffix: str) -> str:
+    """创建空的临时文件并返回路径 (阻塞，在线程中调用)"""
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    return path
+
+
+def open_upload_buffer(size: Optional[int]) -> BinaryIO:
+    """上传文件的下载缓冲 (阻塞，在线程中调用)
+    小文件用 BytesIO，较大或大小未知时用匿名临时文件 (关闭即删除)；
+    两者都可直接交给 zipfile (SpooledTemporaryFile 在 Python 3.11 之前不行)
+    """
+    if size is not None and size <= UPLOAD_SPOOL_THRESHOLD:
+        return io.BytesIO()
+    return tempfile.TemporaryFile()
+
+
+# ============== 链接解析与导入 ==============
+
+LINK_KIND_PUBLIC = "public"   # 公开群组/频道，target 为用户名
+LINK_KIND_INVITE = "invite"   # 私有邀请链接，target 为邀请 hash
+LINK_KIND_INVALID = "invalid" # 旧数据中无法解析的链接 (保留原文，任务跳过)
+
+TG_LINK_RE = re.compile(r"^(?:https?://)?(?:www\.)?(?:t|telegram)\.me/(.+)$", re.IGNORECASE)
+USERNAME_RE = re.compile(r"^[A-Za-z][A-Za-z0-9_]{3,31}$")
+INVITE_HASH_RE = re.compile(r"^[A-Za-z0-9_-]{4,64}$")
+
+
+def canonical_link(link: str) -> str:
+    """规范化链接；无法解析时原样返回 (用于迁移旧记录)"""
+    parsed = parse_link(link)
+    return parsed[0] if parsed else link
+
+
+def parse_link(line: str) -> Optional[Tuple[str, str, str]]:
+    """解析并规范化单行链接
+    返回: (规范链接, 类型, 目标) ，无效时返回 None
+    @name / t.me/name / https://t.me/name/ 都会规范为 https://t.me/name
+    """
+    link = line.strip().lstrip("\ufeff")
+    if not link or len(link) > MAX_LINK_LENGTH or any(c.isspace() for c in link):
+        return None
+    
+    match = TG_LINK_RE.match(link)
+    if match:
+        path = match.group(1).split("?")[0].split("#")[0].strip("/")
+        parts = path.split("/")
+        if parts[0].lower() == "joinchat" and len(parts) > 1:
+            # 旧式邀请链接: t.me/joinchat/HASH
+            value = "+" + parts[1]
+        else:
+            value = parts[0]
+    elif link.startswith("@") or link.startswith("+"):
+        value = link
+    else:
+        return None
+    
+    if value.startswith("+"):
+        invite_hash = value[1:]
+        if not INVITE_HASH_RE.match(invite_hash):
+            return None
+        return f"https://t.me/+{invite_hash}", LINK_KIND_INVITE, invite_hash
+    
+    # 用户名不区分大小写，统一小写
+    username = value.lstrip("@").lower()
+    if not USERNAME_RE.match(username):
+        return None
+    return f"https://t.me/{username}", LINK_KIND_PUBLIC, username
+
+
+def iter_text_lines(file_path: str, chunk_size: int = LINK_IMPORT_CHUNK_SIZE,
+                    max_length: int = MAX_IMPORT_LINE_LENGTH) -> Iterator[Optional[str]]:
+    """按块读取并增量解码 UTF-8 文本，逐行产出 (通用换行符: \n / \r\n / \r)
+    超过 max_length 的行只读过不缓存，产出 None；内存占用与文件大小和行长无关
+    """
+    with open(file_path, "rb", buffering=chunk_size) as raw, \
+            io.TextIOWrapper(raw, encoding="utf-8", errors="replace", newline=None) as f:
+        while True:
+            line = f.readline(max_length + 1)
+            if not line:
+                break
+            if line.endswith("\n"):
+                yield line[:-1]
+            elif len(line) <= max_length:
+                # 文件末尾没有换行符的最后一行
+                yield line
+            else:
+                # 超长行: 跳过剩余部分
+                while True:
+                    rest = f.readline(max_length + 1)
+                    if not rest or rest.endswith("\n"):
+                        break
+                yield None
+
+
+def read_link_batch(lines: Iterator[Optional[str]], size: int) -> Tuple[List[Tuple[str, str, str]], int, bool]:
+    """从行迭代器读取并解析最多 size 个有效链接 (阻塞，在线程中调用)
+    返回: (解析结果, 无效行数, 是否已读完)
+    """
+    batch = []
+    invalid = 0
+    for line in lines:
+        if line is None:
+            invalid += 1
+            continue
+        if not line.strip():
+            continue
+        parsed = parse_link(line)
+        if parsed is None:
+            invalid += 1
+            continue
+        batch.append(parsed)
+        if len(batch) >= size:
+            return batch, invalid, False
+    return batch, invalid, True
+
+
+async def import_links_file(user_id: int, file_path: str) -> Tuple[int, int, int]:
+    """流式导入链接文件 (读文件和解析在线程中，写库在事件循环中，按批交替)
+    返回: (新增数量, 重复数量, 无效数量)
+    """
+    added = duplicates = invalid = 0
+    lines = iter_text_lines(file_path)
+    try:
+        while True:
+            batch, bad, exhausted = await asyncio.to_thread(read_link_batch, lines, LINK_IMPORT_BATCH_SIZE)
+            invalid += bad
+            if batch:
+                inserted = await add_links_batch(user_id, batch)
+                added += inserted
+                duplicates += len(batch) - inserted
+            if exhausted:
+                break
+    finally:
+        lines.close()
+    
+    return added, duplicates, invalid
+
+# ============== 账户管理 ==============
+
+def is_session_file_path(session_string: str) -> bool:
+    """判断是否是 session 文件路径"""
+    if not session_string:
+        return False
+    # 检查文件是否存在（带或不带 .session 后缀）
+    if session_string.endswith('.session'):
+        return os.path.exists(session_string)
+    return os.path.exists(f"{session_string}.session")
 
 
 def clean_phone_number(phone: str) -> str:
@@ -485,16 +2676,17 @@ def clean_phone_number(phone: str) -> str:
     return phone.replace('+', '').replace('-', '').replace(' ', '').replace('(', '').replace(')', '')
 
 
-def get_telegram_client(session_string: str, use_proxy: bool = True) -> TelegramClient:
-    """根据 session 类型创建 TelegramClient"""
+def get_telegram_client(session_string: str, use_proxy: bool = True, proxy: Optional[ProxyRecord] = None) -> TelegramClient:
+    """根据 session 类型创建 TelegramClient (未指定 proxy 时自动轮换)"""
     proxy_tuple = None
     
     # 如果启用代理，获取下一个代理
     if use_proxy:
-        proxy = get_next_proxy()
+        if proxy is None:
+            proxy = get_next_proxy()
         if proxy:
             proxy_tuple = get_proxy_for_telethon(proxy)
-            logger.info(f"使用代理: {mask_proxy(proxy)}")
+            logger.info(f"使用代理: {mask_proxy(proxy)}", extra={"sample": "proxy_use"})
     
     if is_session_file_path(session_string):
         # 文件路径
@@ -505,21 +2697,140 @@ def get_telegram_client(session_string: str, use_proxy: bool = True) -> Telegram
         return TelegramClient(StringSession(session_string), API_ID, API_HASH, proxy=proxy_tuple)
 
 
+class PooledClient:
+    """连接池中的一个已授权客户端"""
+    __slots__ = ("client", "proxy", "last_used", "last_checked")
+    
+    def __init__(self, client: TelegramClient, proxy: Optional[ProxyRecord]):
+        self.client = client
+        self.proxy = proxy
+        self.last_used = time.monotonic()
+        self.last_checked = self.last_used
+
+
+class TelegramClientPool:
+    """按账户复用已连接、已授权的 TelegramClient
+    
+    同一任务内各链接之间保持连接，只在首次使用、连接断开或健康检查失败时
+    重新建立 MTProto 连接；超过 idle_timeout 未使用的客户端会被断开回收。
+    """
+    
+    def __init__(self, max_size: int, idle_timeout: float, health_check_interval: float):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self._entries: "OrderedDict[int, PooledClient]" = OrderedDict()
+        self._unauthorized = set()
+        self._sweeper: Optional[asyncio.Task] = None
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def start(self):
+        """启动空闲回收任务"""
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop(), name="client-pool-sweeper")
+    
+    def is_unauthorized(self, account_id: int) -> bool:
+        """本任务中已确认未授权的账户"""
+        return account_id in self._unauthorized
+    
+    async def acquire(self, account: Dict) -> Optional[PooledClient]:
+        """获取账户的已连接客户端，账户未授权时返回 None"""
+        account_id = account["id"]
+        if account_id in self._unauthorized:
+            return None
+        
+        entry = self._entries.get(account_id)
+        if entry is not None:
+            if await self._is_healthy(entry):
+                self._entries.move_to_end(account_id)
+                entry.last_used = time.monotonic()
+                return entry
+            await self.discard(account_id)
+        
+        proxy = get_next_proxy()
+        client = get_telegram_client(account["session_string"], proxy=proxy)
+        try:
+            await client.connect()
+            if not await client.is_user_authorized():
+                await client.disconnect()
+                self._unauthorized.add(account_id)
+                return None
+        except BaseException:
+            await client.disconnect()
+            raise
+        
+        # 超出容量时淘汰最久未使用的客户端
+        while len(self._entries) >= self.max_size:
+            oldest_id = next(iter(self._entries))
+            await self.discard(oldest_id)
+        
+        entry = PooledClient(client, proxy)
+        self._entries[account_id] = entry
+        return entry
+    
+    async def discard(self, account_id: int):
+        """断开并移除账户的客户端"""
+        entry = self._entries.pop(account_id, None)
+        if entry is None:
+            return
+        try:
+            await entry.client.disconnect()
+        except Exception as e:
+            logger.warning(f"断开客户端失败 (账户 {account_id}): {e}")
+    
+    async def close(self):
+        """断开所有客户端"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        for account_id in list(self._entries):
+            await self.discard(account_id)
+    
+    async def _is_healthy(self, entry: PooledClient) -> bool:
+        """健康检查：连接仍在；长时间未检查时再发一次轻量 RPC"""
+        if not entry.client.is_connected():
+            return False
+        
+        now = time.monotonic()
+        if now - entry.last_checked < self.health_check_interval:
+            return True
+        try:
+            await asyncio.wait_for(
+                entry.client(functions.updates.GetStateRequest()),
+                CLIENT_POOL_HEALTH_CHECK_TIMEOUT
+            )
+        except Exception as e:
+            logger.warning(f"客户端健康检查失败: {e}")
+            return False
+        entry.last_checked = now
+        return True
+    
+    async def _sweep_loop(self):
+        """定期断开空闲客户端"""
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            deadline = time.monotonic() - self.idle_timeout
+            for account_id, entry in list(self._entries.items()):
+                if entry.last_used < deadline:
+                    await self.discard(account_id)
+
+
 async def check_account_status(session_string: str) -> Tuple[bool, str, bool]:
     """
     检查账户状态
     返回: (是否在线, 状态信息, 是否被封禁)
     """
+    client = None
     try:
         client = get_telegram_client(session_string)
         await client.connect()
         
         if await client.is_user_authorized():
             me = await client.get_me()
-            await client.disconnect()
             return True, f"online - {me.phone}", False
         else:
-            await client.disconnect()
             return False, "未授权", False
             
     except errors.UserDeactivatedBanError:
@@ -531,43 +2842,128 @@ async def check_account_status(session_string: str) -> Tuple[bool, str, bool]:
     except Exception as e:
         logger.error(f"检查账户状态失败: {e}")
         return False, str(e), False
+    finally:
+        if client is not None:
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
+
+
+def remove_session_file(session_string: str):
+    """删除账户对应的 session 文件 (如果是文件 session)"""
+    if not is_session_file_path(session_string):
+        return
+    session_path = session_string
+    if not session_path.endswith('.session'):
+        session_path += '.session'
+    if os.path.exists(session_path):
+        os.remove(session_path)
+
+
+async def refresh_accounts_status(accounts: List[Dict], progress=None) -> Dict[str, int]:
+    """并发检查账户状态，结果在一个事务中批量写回
+    progress: 可选回调 progress(已完成, 总数, 计数)
+    返回: {"online": n, "offline": n, "removed": n}
+    """
+    # 检查时按轮换取代理，先确保代理列表是最新的
+    await load_proxies()
+    semaphore = asyncio.Semaphore(ACCOUNT_CHECK_CONCURRENCY)
+    counts = {"online": 0, "offline": 0, "removed": 0}
+    status_updates = []
+    banned = []
+    
+    async def check_one(account: Dict):
+        async with semaphore:
+            try:
+                result = await asyncio.wait_for(
+                    check_account_status(account["session_string"]),
+                    ACCOUNT_CHECK_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                result = (False, "检查超时", False)
+            return account, result
+    
+    tasks = [check_one(acc) for acc in accounts]
+    for done, future in enumerate(asyncio.as_completed(tasks), 1):
+        account, (is_online, status, is_banned) = await future
+        if is_banned:
+            banned.append(account)
+            counts["removed"] += 1
+        else:
+            status = "online" if is_online else "offline"
+            status_updates.append((status, account["id"]))
+            counts[status] += 1
+        if progress:
+            await progress(done, len(accounts), counts)
+    
+    await apply_account_status_batch(status_updates, [acc["id"] for acc in banned])
+    
+    # 自动删除封禁账户的 session 文件
+    for account in banned:
+        try:
+            await asyncio.to_thread(remove_session_file, account["session_string"])
+        except OSError as e:
+            logger.warning(f"删除 session 文件失败: {e}")
+    
+    return counts
 
 # ============== 加群核心 ==============
 
-async def join_group(client: TelegramClient, link: str) -> Tuple[bool, str]:
-    """加群核心逻辑"""
+async def resolve_channel(client: TelegramClient, account_id: int, username: str) -> Tuple[types.InputChannel, bool]:
+    """解析公开群组/频道用户名，优先使用持久化缓存
+    返回: (InputChannel, 是否来自缓存)
+    """
+    cached = await get_cached_entity(account_id, username)
+    if cached:
+        return types.InputChannel(cached["peer_id"], cached["access_hash"]), True
+    
+    result = await client(functions.contacts.ResolveUsernameRequest(username=username))
+    channel = next((c for c in result.chats if isinstance(c, types.Channel)), None)
+    if channel is None:
+        raise ValueError("该用户名不是群组或频道")
+    
+    peer_type = "megagroup" if channel.megagroup else "channel"
+    await put_cached_entity(account_id, username, channel.id, channel.access_hash, peer_type)
+    return types.InputChannel(channel.id, channel.access_hash), False
+
+
+async def join_group(client: TelegramClient, account_id: int, kind: str, target: str) -> JoinResult:
+    """加群核心逻辑 (kind/target 来自 parse_link，入库时已解析)"""
     try:
-        # 解析链接
-        if "t.me/" in link:
-            username = link.split("t.me/")[1].split("?")[0].strip("/")
-        else:
-            username = link.strip()
-        
-        # 尝试加入
-        if username.startswith("+"):
+        if kind == LINK_KIND_INVITE:
             # 私有群组邀请链接
-            result = await client(functions.messages.ImportChatInviteRequest(
-                hash=username[1:]
+            await client(functions.messages.ImportChatInviteRequest(
+                hash=target
             ))
         else:
             # 公开群组
-            result = await client(functions.channels.JoinChannelRequest(
-                channel=username
-            ))
+            channel, from_cache = await resolve_channel(client, account_id, target)
+            try:
+                await client(functions.channels.JoinChannelRequest(channel=channel))
+            except (errors.ChannelInvalidError, errors.PeerIdInvalidError):
+                if not from_cache:
+                    raise
+                # 缓存的 access_hash 已失效，重新解析一次
+                await drop_cached_entity(account_id, target)
+                channel, _ = await resolve_channel(client, account_id, target)
+                await client(functions.channels.JoinChannelRequest(channel=channel))
         
-        return True, "加群成功"
+        return JoinResult(JoinOutcome.SUCCESS)
     
     except errors.FloodWaitError as e:
-        return False, f"被限制，需等待 {e.seconds} 秒"
+        return JoinResult(JoinOutcome.FLOOD_WAIT, detail=e.seconds)
     except errors.UserAlreadyParticipantError:
-        return False, "已经在群里"
+        return JoinResult(JoinOutcome.ALREADY_JOINED)
     except errors.InviteHashExpiredError:
-        return False, "邀请链接已过期"
+        return JoinResult(JoinOutcome.INVITE_EXPIRED)
     except errors.ChannelPrivateError:
-        return False, "群组为私有"
+        return JoinResult(JoinOutcome.PRIVATE)
+    except errors.UsernameNotOccupiedError:
+        return JoinResult(JoinOutcome.USERNAME_INVALID)
     except Exception as e:
         logger.error(f"加群失败: {e}")
-        return False, str(e)
+        return JoinResult(JoinOutcome.FAILED, error=str(e))
 
 async def auto_verify(client: TelegramClient) -> bool:
     """自动过验证（简单实现）"""
@@ -580,40 +2976,304 @@ async def auto_verify(client: TelegramClient) -> bool:
         logger.error(f"自动验证失败: {e}")
         return False
 
-async def test_proxy_connection(proxy: Dict) -> Tuple[bool, str]:
-    """测试代理连通性"""
-    try:
-        proxy_tuple = get_proxy_for_telethon(proxy)
+class CsvReportWriter:
+    """追加写入的 CSV 报告
+    add() 只把行放进内存；flush()/close() 在线程中打开、写入、关闭文件，不阻塞事件循环
+    """
+    
+    def __init__(self, path: str, header: List[str], append: bool = False):
+        self.path = path
+        self.header = header
+        self.append = append
+        self._pending: List[list] = []
+        self._file = None
+        self._writer = None
+        self._closed = False
+        self._flush_lock = asyncio.Lock()   # 保证各批按顺序写入
+    
+    def add(self, row: list):
+        self._pending.append(row)
+    
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending or self._closed:
+                return
+            rows, self._pending = self._pending, []
+            await asyncio.to_thread(self._write, rows)
+    
+    async def close(self):
+        """写完剩余的行并关闭 (没有任何记录时也会生成只含表头的文件)"""
+        async with self._flush_lock:
+            if self._closed:
+                return
+            self._closed = True
+            rows, self._pending = self._pending, []
+            await asyncio.to_thread(self._write, rows, True)
+    
+    def _write(self, rows: List[list], close: bool = False):
+        if self._file is None:
+            # 从断点继续时追加到上次的报告
+            self._file = open(self.path, "a" if self.append else "w", newline="", encoding="utf-8-sig")
+            self._writer = csv.writer(self._file)
+            if not self.append or self._file.tell() == 0:
+                self._writer.writerow(self.header)
+        self._writer.writerows(rows)
+        if close:
+            self._file.close()
+        else:
+            # 任务运行中也能下载到最新的报告
+            self._file.flush()
+
+
+class TaskProgress:
+    """加群任务的实时进度
+    
+    整个任务只用一条状态消息，原地编辑并按 TASK_PROGRESS_INTERVAL 节流；
+    每次尝试同时追加到 REPORTS_DIR 下的 CSV 报告，任务结束后可下载。
+    """
+    
+    def __init__(self, user_id: int, message, controller: "TaskController",
+                 daily_limit: int, today_success: int, total_links: int,
+                 resumed: bool = False, interval: float = TASK_PROGRESS_INTERVAL):
+        self.user_id = user_id
+        self.message = message
+        self.controller = controller
+        self.daily_limit = daily_limit
+        self.today_success = today_success
+        self.total_links = total_links
+        self.resumed = resumed
+        self.interval = interval
         
-        # 使用代理创建临时 client 测试连接
-        client = TelegramClient(
-            StringSession(),
-            API_ID,
-            API_HASH,
-            proxy=proxy_tuple
+        self.success = 0
+        self.failed = 0
+        self.errors = 0
+        self.done_links = 0
+        self.skipped_links = 0
+        self.current_link: Optional[str] = None
+        self.current_account: Optional[str] = None
+        self.recent_errors = deque(maxlen=TASK_RECENT_ERRORS)
+        self._last_edit = 0.0
+        self._finished = False
+        self._title: Optional[str] = None
+        
+        self.report_path = get_task_report_path(user_id)
+        self._report = CsvReportWriter(
+            self.report_path, ["时间", "链接", "账户", "结果", "信息", "代理"], append=resumed
         )
+    
+    def record(self, link: str, phone: str, result: JoinResult, proxy: Optional[ProxyRecord] = None):
+        """记录一次加群尝试"""
+        status, message = result.status, result.message
+        if status == "success":
+            self.success += 1
+            self.today_success += 1
+        elif status == "failed":
+            self.failed += 1
+        else:
+            self.errors += 1
+        if status != "success":
+            self.recent_errors.append(f"{phone} · {link}: {message}"[:120])
         
-        # 尝试连接
-        await client.connect()
-        connected = client.is_connected()
-        await client.disconnect()
+        self._report.add([
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            link, phone, status, message,
+            mask_proxy(proxy) if proxy else "",
+        ])
+    
+    def skip_link(self):
+        """链接已有成功记录，跳过"""
+        self.skipped_links += 1
+        self.finish_link()
+    
+    def finish_link(self):
+        self.done_links += 1
+        self.current_account = None
+    
+    def render(self, title: Optional[str] = None) -> str:
+        if title is None:
+            if self.controller.stop_requested:
+                title = "⏹️ 正在停止..."
+            elif self.controller.is_paused:
+                title = "⏸️ 任务已暂停"
+            else:
+                title = "🚀 任务运行中"
         
-        if connected:
-            return True, f"✅ 代理连接成功\n代理: {mask_proxy(proxy)}"
-        else:
-            return False, f"❌ 代理连接失败\n代理: {mask_proxy(proxy)}"
+        lines = [
+            title,
+            "",
+            f"链接: {self.done_links}/{self.total_links}" + (f" (跳过已成功 {self.skipped_links})" if self.skipped_links else ""),
+            f"今日进度: {self.today_success}/{self.daily_limit}",
+            f"本次任务: ✅ {self.success}  ❌ {self.failed}  ⚠️ {self.errors}",
+        ]
+        if self.resumed:
+            lines.append("⏩ 从断点继续")
+        if self.current_link and not self._finished:
+            current = f"当前: {self.current_link}"
+            if self.current_account:
+                current += f"\n账户: {self.current_account}"
+            lines.append(current)
+        if self.recent_errors:
+            lines.append("")
+            lines.append("最近错误:")
+            lines.extend(f"• {e}" for e in self.recent_errors)
+        return "\n".join(lines)
     
-    except Exception as e:
-        logger.error(f"测试代理连接失败: {e}")
-        return False, f"❌ 代理连接异常\n代理: {mask_proxy(proxy)}\n错误: {str(e)}"
+    def detach(self, message_id: int):
+        """状态消息被用于其他菜单时停止编辑，直到再次打开任务控制"""
+        if self.message is not None and self.message.message_id == message_id:
+            self.message = None
+    
+    async def refresh(self, force: bool = False):
+        """写入报告中新增的行，并编辑状态消息 (节流，force 时立即编辑)"""
+        await self._report.flush()
+        if self.message is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_edit < self.interval:
+            return
+        self._last_edit = now
+        keyboard = get_task_report_keyboard() if self._finished else get_task_control_keyboard(self.user_id)
+        try:
+            # 后台优先级: 排在菜单操作之后，排队中的旧进度会被新内容合并
+            await self.message.get_bot().edit_message_text(
+                chat_id=self.message.chat_id,
+                message_id=self.message.message_id,
+                text=self.render(self._title),
+                reply_markup=keyboard,
+                rate_limit_args=SEND_PRIORITY_BACKGROUND,
+            )
+        except Exception as e:
+            logger.debug(f"更新任务进度失败: {e}")
+    
+    async def finish(self, title: str):
+        """任务结束: 显示最终结果和下载报告按钮"""
+        self._finished = True
+        self._title = title
+        await self.refresh(force=True)
+    
+    async def close_report(self):
+        await self._report.close()
+
+
+def get_task_report_path(user_id: int) -> str:
+    """用户最近一次任务的报告文件"""
+    return os.path.join(REPORTS_DIR, f"task_{user_id}.csv")
+
 
-async def run_join_task(user_id: int, update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """运行加群任务"""
-    task_running[user_id] = True
-    task_paused[user_id] = False
+class TaskController:
+    """单个用户加群任务的控制器
+    
+    暂停/继续/停止基于 asyncio.Event，任务在检查点和延迟等待中立即响应；
+    停止后超过 TASK_STOP_GRACE 秒仍未结束 (例如卡在网络请求) 则取消任务。
+    """
+    
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.state = "running"   # running / paused / stopping / finished / stopped / failed
+        self.error: Optional[BaseException] = None
+        self.task: Optional[asyncio.Task] = None
+        self.progress: Optional[TaskProgress] = None
+        self._resume_event = asyncio.Event()
+        self._resume_event.set()
+        self._stop_event = asyncio.Event()
+    
+    @property
+    def is_active(self) -> bool:
+        """任务是否仍在运行 (含暂停中)"""
+        return self.task is not None and not self.task.done()
+    
+    @property
+    def is_paused(self) -> bool:
+        return self.state == "paused"
+    
+    @property
+    def stop_requested(self) -> bool:
+        return self._stop_event.is_set()
+    
+    def start(self, coro) -> asyncio.Task:
+        """在后台运行任务协程并跟踪其结果"""
+        self.task = asyncio.create_task(coro, name=f"join-task-{self.user_id}")
+        self.task.add_done_callback(self._on_done)
+        return self.task
+    
+    def pause(self):
+        if self.is_active and not self.stop_requested:
+            self.state = "paused"
+            self._resume_event.clear()
     
+    def resume(self):
+        if self.is_active and not self.stop_requested:
+            self.state = "running"
+            self._resume_event.set()
+    
+    def stop(self):
+        if not self.is_active:
+            return
+        self.state = "stopping"
+        self._stop_event.set()
+        self._resume_event.set()
+        asyncio.get_running_loop().call_later(TASK_STOP_GRACE, self._cancel_if_running)
+    
+    async def wait_if_paused(self) -> bool:
+        """暂停时等待继续或停止，返回任务是否应继续"""
+        await self._resume_event.wait()
+        return not self.stop_requested
+    
+    async def sleep(self, delay: float) -> bool:
+        """可被停止立即打断的延迟，返回任务是否应继续"""
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        return not self.stop_requested
+    
+    def _cancel_if_running(self):
+        if self.is_active:
+            logger.warning(f"任务 {self.user_id} 未在 {TASK_STOP_GRACE} 秒内停止，取消任务")
+            self.task.cancel()
+    
+    def _on_done(self, task: asyncio.Task):
+        if task.cancelled():
+            self.state = "stopped"
+        elif task.exception() is not None:
+            self.state = "failed"
+            self.error = task.exception()
+            logger.error(f"加群任务异常结束 (用户 {self.user_id})", exc_info=self.error)
+        else:
+            self.state = "stopped" if self.stop_requested else "finished"
+        logger.info(f"加群任务结束 (用户 {self.user_id}): {self.state}")
+
+
+def get_task_controller(user_id: int) -> Optional[TaskController]:
+    """获取用户正在运行的任务控制器"""
+    controller = task_controllers.get(user_id)
+    if controller is not None and controller.is_active:
+        return controller
+    return None
+
+
+async def stop_all_join_tasks(timeout: float):
+    """停止所有运行中的加群任务并等待收尾 (写完统计和断点、断开客户端)"""
+    controllers = [c for c in task_controllers.values() if c.is_active]
+    if not controllers:
+        return
+    logger.info(f"正在停止 {len(controllers)} 个加群任务...")
+    for controller in controllers:
+        controller.stop()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(c.task for c in controllers), return_exceptions=True),
+            timeout
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"加群任务未在 {timeout} 秒内结束，已取消")
+
+
+async def run_join_task(user_id: int, update: Update, context: ContextTypes.DEFAULT_TYPE, controller: TaskController):
+    """运行加群任务 (由 controller 控制暂停/停止)"""
     # 检查代理
-    proxies = load_proxies()
+    proxies = await load_proxies()
+    alive_proxies = proxy_registry.alive_records
     if not proxies:
         await update.callback_query.message.edit_text(
             "❌ 未找到可用代理\n\n"
@@ -625,16 +3285,16 @@ async def run_join_task(user_id: int, update: Update, context: ContextTypes.DEFA
             "• socks5://host:port\n"
             "• ABC格式: xxx.abcproxy.vip:4950:user:pass"
         )
-        task_running[user_id] = False
         return
     
-    # 测试代理连通性
-    proxy_ok, proxy_msg = await test_proxy_connection(proxies[0])
+    # 测试代理连通性 (优先使用未被标记失效的代理)
+    first_proxy = (alive_proxies or proxies)[0]
+    proxy_ok, _, proxy_error = await check_proxy(first_proxy)
     if not proxy_ok:
+        logger.error(f"任务启动前代理检测失败: {proxy_error}")
         await update.callback_query.message.edit_text(
-            f"❌ 代理连接失败\n\n{proxy_msg}\n\n请检查代理配置"
+            f"❌ 代理连接失败\n\n代理: {mask_proxy(first_proxy)}\n错误: {proxy_error}\n\n请检查代理配置"
         )
-        task_running[user_id] = False
         return
     
     # 获取设置
@@ -644,101 +3304,179 @@ async def run_join_task(user_id: int, update: Update, context: ContextTypes.DEFA
     daily_limit = settings["daily_limit"]
     
     # 获取今日已加群数量
-    success_count, failed_count = await get_today_stats(user_id)
+    success_count, _ = await get_today_stats(user_id)
     
-    # 获取账户和链接
+    # 读取断点 (上次停止/重启前的位置)
+    task_cursor = await get_task_cursor(user_id)
+    if task_cursor:
+        start_link_id = task_cursor["link_id"]
+        resume_tried = task_cursor["tried_accounts"]
+        task_success = task_cursor["success"]
+        task_failed = task_cursor["failed"]
+    else:
+        start_link_id, resume_tried, task_success, task_failed = 0, set(), 0, 0
+    
+    # 获取账户；链接只取数量和范围，运行时逐批读取
+    # 范围固定在启动时的最大 id，任务期间新导入的链接留给下一轮
     accounts = await get_accounts(user_id)
-    links = await get_links(user_id)
+    total_links, end_link_id = await get_link_range(user_id, start_link_id)
     
     if not accounts:
         await update.callback_query.message.edit_text("❌ 没有可用账户")
-        task_running[user_id] = False
         return
     
-    if not links:
-        await update.callback_query.message.edit_text("❌ 没有可用链接")
-        task_running[user_id] = False
+    if not total_links:
+        if task_cursor:
+            # 断点之后已无链接，上一轮已跑完
+            await clear_task_cursor(user_id)
+            await update.callback_query.message.edit_text("✅ 所有链接已处理完毕")
+        else:
+            await update.callback_query.message.edit_text("❌ 没有可用链接")
         return
     
-    # 开始加群
-    for link_data in links:
-        if not task_running.get(user_id):
-            break
-        
-        # 检查暂停
-        while task_paused.get(user_id):
-            await asyncio.sleep(1)
-        
-        # 检查每日限制
-        if success_count >= daily_limit:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"✅ 已达到每日上限 {daily_limit}，任务结束"
-            )
-            break
-        
-        link = link_data["link"]
-        
-        # 轮换账户
-        for account in accounts:
-            if not task_running.get(user_id):
+    # 实时进度消息 (原地编辑启动时的消息) + 逐条尝试报告
+    progress = TaskProgress(
+        user_id, update.callback_query.message, controller,
+        daily_limit, success_count, total_links,
+        resumed=task_cursor is not None,
+    )
+    progress.success, progress.failed = task_success, task_failed
+    controller.progress = progress
+    await progress.refresh(force=True)
+    
+    # 开始加群 (任务内按账户复用连接)
+    client_pool = TelegramClientPool(
+        CLIENT_POOL_MAX_SIZE,
+        CLIENT_POOL_IDLE_TIMEOUT,
+        CLIENT_POOL_HEALTH_CHECK_INTERVAL,
+    )
+    client_pool.start()
+    completed = False
+    limit_reached = False
+    cancelled = False
+    failure: Optional[Exception] = None
+    try:
+        async for link_data in iter_links(user_id, start_link_id, end_link_id):
+            # 检查暂停/停止 (暂停期间没有新记录触发写入，先把统计和断点落盘)
+            if controller.is_paused:
+                await stats_writer.flush()
+            if not await controller.wait_if_paused():
                 break
             
-            try:
-                # 使用 helper 函数创建 client (会自动轮换代理)
-                # 获取当前将使用的代理信息
-                current_proxy = None
-                if proxy_list:
-                    current_proxy = proxy_list[(proxy_index - 1) % len(proxy_list)]
-                
-                client = get_telegram_client(account["session_string"])
-                await client.connect()
-                
-                if not await client.is_user_authorized():
-                    await update_account_status(account["id"], "unauthorized")
-                    await client.disconnect()
+            # 检查每日限制
+            if progress.today_success >= daily_limit:
+                limit_reached = True
+                break
+            
+            link = link_data["link"]
+            link_id = link_data["id"]
+            progress.current_link = link
+            
+            # 已成功过的链接直接跳过
+            if await has_link_succeeded(user_id, link):
+                resume_tried = set()
+                progress.skip_link()
+                await progress.refresh()
+                continue
+            
+            # 断点所在链接只用还没尝试过的账户
+            tried = [a["id"] for a in accounts if a["id"] in resume_tried] if link_id == start_link_id else []
+            resume_tried = set()
+            
+            # 轮换账户
+            for account in accounts:
+                if controller.is_paused:
+                    await stats_writer.flush()
+                if not await controller.wait_if_paused():
+                    break
+                if account["id"] in tried or client_pool.is_unauthorized(account["id"]):
                     continue
                 
-                # 加群
-                success, message = await join_group(client, link)
-                
-                # 构建代理信息
-                proxy_info = f"\n代理: {mask_proxy(current_proxy)}" if current_proxy else ""
-                
-                if success:
-                    success_count += 1
-                    await add_stat(user_id, account["id"], link, "success", message)
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=f"✅ 成功: {link}\n账户: {account['phone']}{proxy_info}\n进度: {success_count}/{daily_limit}"
+                progress.current_account = account["phone"]
+                try:
+                    pooled = await client_pool.acquire(account)
+                    if pooled is None:
+                        # 首次发现未授权时写一次状态，之后的链接直接跳过该账户
+                        await update_account_status(account["id"], "unauthorized")
+                        continue
+                    
+                    # 加群
+                    result = await join_group(
+                        pooled.client, account["id"], link_data["kind"], link_data["target"]
                     )
-                else:
-                    failed_count += 1
-                    await add_stat(user_id, account["id"], link, "failed", message)
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=f"❌ 失败: {link}\n原因: {message}{proxy_info}"
-                    )
-                
-                await client.disconnect()
-                
-                # 随机延迟
-                delay = random.randint(interval_min, interval_max)
-                await asyncio.sleep(delay)
-                
-                # 成功就跳到下一个链接
-                if success:
-                    break
-                
-            except Exception as e:
-                logger.error(f"加群任务异常: {e}")
-                await add_stat(user_id, account["id"], link, "error", str(e))
+                    success = result.success
+                    
+                    tried.append(account["id"])
+                    await add_stat(user_id, account["id"], link, result)
+                    progress.record(link, account["phone"], result, pooled.proxy)
+                    await progress.refresh()
+                    
+                    # 保存断点 (随统计批量写入): 成功则指向下一个链接
+                    if success:
+                        save_task_cursor(user_id, link_id + 1, [], progress.success, progress.failed)
+                    else:
+                        save_task_cursor(user_id, link_id, tried, progress.success, progress.failed)
+                    
+                    # 随机延迟 (停止时立即结束)
+                    delay = random.randint(interval_min, interval_max)
+                    await controller.sleep(delay)
+                    
+                    # 成功就跳到下一个链接
+                    if success:
+                        break
+                    
+                except Exception as e:
+                    logger.error(f"加群任务异常: {e}")
+                    await client_pool.discard(account["id"])
+                    result = JoinResult(JoinOutcome.ERROR, error=str(e))
+                    await add_stat(user_id, account["id"], link, result)
+                    progress.record(link, account["phone"], result)
+                    await progress.refresh()
+                    tried.append(account["id"])
+                    save_task_cursor(user_id, link_id, tried, progress.success, progress.failed)
+            else:
+                # 所有账户都试过仍未成功，断点移到下一个链接
+                save_task_cursor(user_id, link_id + 1, [], progress.success, progress.failed)
+            
+            if controller.stop_requested:
+                break
+            progress.finish_link()
+        else:
+            completed = True
+    except asyncio.CancelledError:
+        # 停止后超时被取消 (卡在连接或加群请求)，收尾后同样显示最终结果
+        cancelled = True
+        raise
+    except Exception as e:
+        # 意外异常: 同样收尾并把进度消息改为最终状态，异常交给 TaskController 记录
+        failure = e
+        raise
+    finally:
+        try:
+            await client_pool.close()
+            await stats_writer.flush()
+            await progress.close_report()
+        except Exception as e:
+            # 收尾本身失败 (如数据库不可写) 也要结束进度消息
+            failure = failure or e
+            raise
+        finally:
+            if cancelled:
+                await progress.finish("⏹️ 任务已停止，下次从断点继续")
+            elif failure is not None:
+                await progress.finish(f"❌ 任务异常: {failure}，下次从断点继续")
     
-    task_running[user_id] = False
-    await context.bot.send_message(
-        chat_id=user_id,
-        text=f"🏁 任务完成\n成功: {success_count}\n失败: {failed_count}"
-    )
+    # 全部链接处理完才清除断点；停止/达到上限时保留，下次从断点继续
+    if completed:
+        await clear_task_cursor(user_id)
+    
+    if completed:
+        title = "🏁 任务完成"
+    elif limit_reached:
+        title = f"✅ 已达到每日上限 {daily_limit}，下次从断点继续"
+    else:
+        title = "⏹️ 任务已停止，下次从断点继续"
+    await progress.finish(title)
 
 # ============== 按钮定义 ==============
 
@@ -797,6 +3535,28 @@ def get_links_menu_keyboard() -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(keyboard)
 
+def get_page_nav_row(prefix: str, rows: List[Dict], has_prev: bool, has_next: bool) -> List[InlineKeyboardButton]:
+    """分页按钮 (<prefix>_prev_<首条id> / <prefix>_next_<末条id>)"""
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"{prefix}_prev_{rows[0]['id']}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("下一页 ➡️", callback_data=f"{prefix}_next_{rows[-1]['id']}"))
+    return nav
+
+def with_nav_row(nav: List[InlineKeyboardButton], markup: InlineKeyboardMarkup) -> InlineKeyboardMarkup:
+    """在菜单键盘上方加分页按钮"""
+    if not nav:
+        return markup
+    return InlineKeyboardMarkup([nav] + [list(row) for row in markup.inline_keyboard])
+
+def parse_page_callback(data: str) -> Tuple[Optional[int], Optional[int]]:
+    """解析分页回调，返回 (after_id, before_id)"""
+    _, direction, cursor_id = data.rsplit("_", 2)
+    if direction == "next":
+        return int(cursor_id), None
+    return None, int(cursor_id)
+
 def get_settings_menu_keyboard() -> InlineKeyboardMarkup:
     """设置子菜单"""
     keyboard = [
@@ -819,6 +3579,10 @@ def get_proxy_menu_keyboard() -> InlineKeyboardMarkup:
         ],
         [
             InlineKeyboardButton("🧪 测试代理", callback_data="test_proxy"),
+            InlineKeyboardButton("🩺 全部检测", callback_data="sweep_proxies"),
+        ],
+        [
+            InlineKeyboardButton("📈 检测报告", callback_data="proxy_report_latency"),
         ],
         [
             InlineKeyboardButton("🔙 返回主菜单", callback_data="main_menu"),
@@ -828,8 +3592,9 @@ def get_proxy_menu_keyboard() -> InlineKeyboardMarkup:
 
 def get_task_control_keyboard(user_id: int) -> InlineKeyboardMarkup:
     """任务控制"""
-    is_running = task_running.get(user_id, False)
-    is_paused = task_paused.get(user_id, False)
+    controller = get_task_controller(user_id)
+    is_running = controller is not None
+    is_paused = is_running and controller.is_paused
     
     keyboard = []
     
@@ -851,8 +3616,108 @@ def get_task_control_keyboard(user_id: int) -> InlineKeyboardMarkup:
     
     return InlineKeyboardMarkup(keyboard)
 
+# 作用于任务状态消息的回调，其余回调会让任务停止编辑该消息
+TASK_PROGRESS_CALLBACKS = {"start_task", "pause_task", "resume_task", "stop_task", "task_report"}
+
+def get_task_report_keyboard() -> InlineKeyboardMarkup:
+    """任务结束"""
+    keyboard = [
+        [InlineKeyboardButton("📄 下载报告", callback_data="task_report")],
+        [InlineKeyboardButton("🔙 返回主菜单", callback_data="main_menu")],
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
 # ============== 回调处理 ==============
 
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+def sparkline(values: List[int]) -> str:
+    """数值序列转为字符趋势图"""
+    peak = max(values) if values else 0
+    if peak <= 0:
+        return SPARK_CHARS[0] * len(values)
+    return "".join(SPARK_CHARS[round(v / peak * (len(SPARK_CHARS) - 1))] for v in values)
+
+def format_counts(success: int, failed: int, error: int) -> str:
+    """✅/❌/⚠️ 计数和成功率"""
+    total = success + failed + error
+    rate = (success / total * 100) if total > 0 else 0
+    return f"✅ {success}  ❌ {failed}  ⚠️ {error}  成功率 {rate:.1f}%"
+
+def render_stats_dashboard(data: Dict, days: int) -> str:
+    """统计面板文本"""
+    now = datetime.now()
+    today = now.strftime("%Y-%m-%d")
+    by_day = {row["day"]: row for row in data["daily"]}
+    empty = {"success": 0, "failed": 0, "error": 0}
+    
+    today_row = by_day.get(today, empty)
+    totals = {k: sum(row[k] for row in data["daily"]) for k in empty}
+    
+    lines = [
+        f"📊 统计面板 (近 {days} 天)",
+        "",
+        f"今日: {format_counts(today_row['success'], today_row['failed'], today_row['error'])}",
+        f"近 {days} 天: {format_counts(totals['success'], totals['failed'], totals['error'])}",
+    ]
+    
+    # 今日每小时成功数
+    by_hour = {int(row["hour"][-2:]): row["success"] for row in data["hourly"]}
+    hours = [by_hour.get(h, 0) for h in range(24)]
+    lines.append("")
+    lines.append("今日每小时成功 (0-23 时):")
+    lines.append(sparkline(hours))
+    if any(hours):
+        peak_hour = max(range(24), key=lambda h: hours[h])
+        lines.append(f"高峰: {peak_hour} 时 ({hours[peak_hour]} 个)")
+    
+    # 每日趋势
+    day_keys = [(now - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days - 1, -1, -1)]
+    lines.append("")
+    lines.append(f"每日成功趋势: {sparkline([by_day.get(d, empty)['success'] for d in day_keys])}")
+    for day in day_keys[-DASHBOARD_TREND_DAYS:]:
+        row = by_day.get(day, empty)
+        lines.append(f"{day[5:]}  ✅ {row['success']}  ❌ {row['failed']}  ⚠️ {row['error']}")
+    
+    if data["accounts"]:
+        lines.append("")
+        lines.append("账户排行:")
+        for acc in data["accounts"]:
+            name = acc["phone"] or f"ID {acc['account_id']} (已删除)"
+            lines.append(f"• {name}  ✅ {acc['success']}  ❌ {acc['failed']}  ⚠️ {acc['error']}")
+    
+    if data["outcomes"]:
+        failures = sum(row["count"] for row in data["outcomes"])
+        lines.append("")
+        lines.append("失败原因:")
+        for row in data["outcomes"]:
+            label = JoinOutcome(row["outcome"]).label
+            lines.append(f"• {label}: {row['count']} ({row['count'] / failures * 100:.0f}%)")
+    
+    return "\n".join(lines)
+
+
+def make_progress_callback(edit, render, interval: float = PROGRESS_EDIT_INTERVAL):
+    """生成节流的进度回调，最多每 interval 秒编辑一次消息 (完成时总会编辑)
+    edit: 编辑消息的协程函数，如 query.edit_message_text / message.edit_text
+    render(done, total, *extra) -> 消息文本
+    """
+    last_edit = time.monotonic()
+    
+    async def report(done: int, total: int, *extra):
+        nonlocal last_edit
+        now = time.monotonic()
+        if done < total and now - last_edit < interval:
+            return
+        last_edit = now
+        try:
+            await edit(render(done, total, *extra))
+        except Exception as e:
+            logger.debug(f"更新进度消息失败: {e}")
+    
+    return report
+
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """启动命令"""
     await update.message.reply_text(
@@ -860,379 +3725,749 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_main_menu_keyboard()
     )
 
+async def perf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """性能统计 (仅管理员): 各按钮回调耗时、队列状态和事件循环延迟"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    text = (
+        f"⏱️ 性能统计\n\n"
+        f"统计写入队列: {stats_writer.depth} (丢弃 {stats_writer.dropped})\n"
+        f"发送队列: {bot_dispatcher.depth} (已合并编辑 {bot_dispatcher.merged_edits}, "
+        f"限流重试 {bot_dispatcher.retry_after_count})\n"
+        f"日志队列: {log_queue_handler.queue.qsize()} (丢弃 {log_queue_handler.dropped}, "
+        f"采样省略 {log_sampler.suppressed_total})\n"
+    )
+    lag_samples = list(loop_monitor.samples)
+    text += (
+        f"事件循环延迟 (ms) p50 / p99 / max: {percentile(lag_samples, 50):.0f} / "
+        f"{percentile(lag_samples, 99):.0f} / {loop_monitor.max_lag_ms:.0f} "
+        f"(超过 {LOOP_LAG_WARN_THRESHOLD * 1000:.0f}ms {loop_monitor.spikes} 次)\n\n"
+    )
+    rows = route_timer.report()
+    if not rows:
+        text += "暂无回调记录"
+    else:
+        text += "回调耗时 (ms) p50 / p95 / p99 / max\n"
+        for row in rows[:30]:
+            errors = f" ❌{row['errors']}" if row["errors"] else ""
+            text += (
+                f"• {row['route']} ×{row['count']}{errors}\n"
+                f"   {row['p50']:.0f} / {row['p95']:.0f} / {row['p99']:.0f} / {row['max']:.0f}\n"
+            )
+    await update.message.reply_text(text)
+
+# 回调路由表: callback_data -> 处理函数；前缀路由用于带参数的回调 (如 del_acc_<id>)
+CALLBACK_ROUTES: Dict[str, Callable] = {}
+CALLBACK_PREFIX_ROUTES: Dict[str, Callable] = {}
+
+def callback_route(pattern: str, prefix: bool = False):
+    """注册按钮回调处理函数，prefix=True 时 pattern 须以 "_" 结尾"""
+    def decorator(handler):
+        if prefix:
+            CALLBACK_PREFIX_ROUTES[pattern] = handler
+        else:
+            CALLBACK_ROUTES[pattern] = handler
+        return handler
+    return decorator
+
+def resolve_callback_route(data: str) -> Tuple[Optional[str], Optional[Callable]]:
+    """查找回调对应的 (路由名, 处理函数)；前缀路由取最后一个 "_" 之前的部分查表"""
+    handler = CALLBACK_ROUTES.get(data)
+    if handler is not None:
+        return data, handler
+    prefix = data.rpartition("_")[0] + "_"
+    handler = CALLBACK_PREFIX_ROUTES.get(prefix)
+    if handler is not None:
+        return prefix, handler
+    return None, None
+
+
+class RouteTimer:
+    """按路由统计回调耗时，每个路由保留最近 window 次样本"""
+    
+    def __init__(self, window: int = ROUTE_TIMING_WINDOW):
+        self.window = window
+        self.samples: Dict[str, deque] = {}
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+    
+    def record(self, route: str, elapsed_ms: float, failed: bool = False):
+        samples = self.samples.get(route)
+        if samples is None:
+            samples = self.samples[route] = deque(maxlen=self.window)
+        samples.append(elapsed_ms)
+        self.counts[route] = self.counts.get(route, 0) + 1
+        if failed:
+            self.errors[route] = self.errors.get(route, 0) + 1
+    
+    def report(self) -> List[Dict]:
+        """各路由的调用次数、错误数和 p50/p95/p99/max (毫秒)，按 p95 降序"""
+        rows = []
+        for route, samples in self.samples.items():
+            values = list(samples)
+            rows.append({
+                "route": route,
+                "count": self.counts[route],
+                "errors": self.errors.get(route, 0),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "max": max(values),
+            })
+        rows.sort(key=lambda row: -row["p95"])
+        return rows
+
+
+route_timer = RouteTimer()
+
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """处理按钮回调"""
+    """处理按钮回调 (查路由表分发并记录耗时)"""
     query = update.callback_query
     await query.answer()
     
     user_id = query.from_user.id
     data = query.data
     
-    # 主菜单
-    if data == "main_menu":
-        await query.edit_message_text(
-            "🏠 主菜单\n\n欢迎使用 Telegram 自动加群机器人",
-            reply_markup=get_main_menu_keyboard()
-        )
+    # 在任务状态消息上进入其他菜单后，任务不再编辑这条消息
+    controller = task_controllers.get(user_id)
+    if controller is not None and controller.progress is not None and data not in TASK_PROGRESS_CALLBACKS:
+        controller.progress.detach(query.message.message_id)
+    
+    route, handler = resolve_callback_route(data)
+    if handler is None:
+        logger.warning(f"未知的按钮回调: {data}")
+        return ConversationHandler.END
+    
+    started = time.perf_counter()
+    try:
+        with loop_monitor.track(route):
+            state = await handler(update, context)
+    except Exception:
+        route_timer.record(route, (time.perf_counter() - started) * 1000, failed=True)
+        raise
+    route_timer.record(route, (time.perf_counter() - started) * 1000)
+    
+    return ConversationHandler.END if state is None else state
+
+
+# 主菜单
+@callback_route("main_menu")
+async def on_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """主菜单"""
+    query = update.callback_query
+    
+    await query.edit_message_text(
+        "🏠 主菜单\n\n欢迎使用 Telegram 自动加群机器人",
+        reply_markup=get_main_menu_keyboard()
+    )
+
+# 账户管理
+@callback_route("menu_accounts")
+async def on_menu_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """账户管理菜单"""
+    query = update.callback_query
+    
+    await query.edit_message_text(
+        "📁 账户管理",
+        reply_markup=get_accounts_menu_keyboard()
+    )
+
+@callback_route("upload_account")
+async def on_upload_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """上传账户"""
+    query = update.callback_query
+    
+    await query.edit_message_text(
+        "请选择登录方式或上传账户文件\n\n"
+        "支持格式：\n"
+        "1. 📱 手动验证码登录 - 发送手机号码\n"
+        "2. 📄 session 文件 (.session)\n"
+        "3. 📋 session+json 文件 (.zip包含两个文件)\n"
+        "4. 📦 ZIP 文件 (包含 session/tdata)\n"
+        "5. 🗂️ tdata 格式 (zip: 手机号/tdata/xxx/key_datas)\n\n"
+        "发送 /cancel 取消"
+    )
+    return UPLOAD_ACCOUNT
+
+@callback_route("list_accounts")
+@callback_route("accounts_next_", prefix=True)
+@callback_route("accounts_prev_", prefix=True)
+async def on_list_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """账户列表 (分页)"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    
+    after_id, before_id = (None, None) if query.data == "list_accounts" else parse_page_callback(query.data)
+    accounts, offset, has_prev, has_next = await fetch_page(
+        "accounts", "id, phone, status", user_id, ACCOUNTS_PAGE_SIZE, after_id, before_id
+    )
+    if not accounts:
+        text = "📋 账户列表\n\n暂无账户"
+    else:
+        total = await count_rows("accounts", user_id)
+        text = f"📋 账户列表 ({offset + 1}-{offset + len(accounts)} / 共 {total} 个)\n\n"
+        for acc in accounts:
+            status_icon = "🟢" if acc["status"] == "online" else "🔴"
+            text += f"{status_icon} ID: {acc['id']}\n"
+            text += f"   手机: {acc['phone'] or '未知'}\n"
+            text += f"   状态: {acc['status']}\n\n"
     
-    # 账户管理
-    elif data == "menu_accounts":
+    nav = get_page_nav_row("accounts", accounts, has_prev, has_next)
+    await query.edit_message_text(
+        text,
+        reply_markup=with_nav_row(nav, get_accounts_menu_keyboard())
+    )
+
+@callback_route("delete_account")
+@callback_route("del_acc_next_", prefix=True)
+@callback_route("del_acc_prev_", prefix=True)
+async def on_delete_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """选择要删除的账户 (分页)"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    
+    after_id, before_id = (None, None) if query.data == "delete_account" else parse_page_callback(query.data)
+    accounts, offset, has_prev, has_next = await fetch_page(
+        "accounts", "id, phone", user_id, ACCOUNTS_PAGE_SIZE, after_id, before_id
+    )
+    if not accounts:
         await query.edit_message_text(
-            "📁 账户管理",
+            "暂无账户可删除",
             reply_markup=get_accounts_menu_keyboard()
         )
-    
-    elif data == "upload_account":
+    else:
+        keyboard = []
+        for acc in accounts:
+            keyboard.append([
+                InlineKeyboardButton(
+                    f"删除 {acc['phone'] or acc['id']}",
+                    callback_data=f"del_acc_{acc['id']}"
+                )
+            ])
+        nav = get_page_nav_row("del_acc", accounts, has_prev, has_next)
+        if nav:
+            keyboard.append(nav)
+        keyboard.append([
+            InlineKeyboardButton("🔙 返回", callback_data="menu_accounts")
+        ])
+        
+        total = await count_rows("accounts", user_id)
         await query.edit_message_text(
-            "请选择登录方式或上传账户文件\n\n"
-            "支持格式：\n"
-            "1. 📱 手动验证码登录 - 发送手机号码\n"
-            "2. 📄 session 文件 (.session)\n"
-            "3. 📋 session+json 文件 (.zip包含两个文件)\n"
-            "4. 📦 ZIP 文件 (包含 session/tdata)\n"
-            "5. 🗂️ tdata 格式 (zip: 手机号/tdata/xxx/key_datas)\n\n"
-            "发送 /cancel 取消"
+            f"选择要删除的账户 ({offset + 1}-{offset + len(accounts)} / 共 {total} 个)：",
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
-        return UPLOAD_ACCOUNT
+
+@callback_route("del_acc_", prefix=True)
+async def on_del_acc(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """删除账户"""
+    query = update.callback_query
+    data = query.data
     
-    elif data == "list_accounts":
-        accounts = await get_accounts(user_id)
-        if not accounts:
-            text = "📋 账户列表\n\n暂无账户"
-        else:
-            text = "📋 账户列表\n\n"
-            for acc in accounts:
-                status_icon = "🟢" if acc["status"] == "online" else "🔴"
-                text += f"{status_icon} ID: {acc['id']}\n"
-                text += f"   手机: {acc['phone'] or '未知'}\n"
-                text += f"   状态: {acc['status']}\n\n"
-        
+    account_id = int(data.split("_")[2])
+    await delete_account(account_id)
+    await query.edit_message_text(
+        "✅ 账户已删除",
+        reply_markup=get_accounts_menu_keyboard()
+    )
+
+@callback_route("refresh_status")
+async def on_refresh_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """刷新账户状态"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    
+    accounts = await get_accounts(user_id)
+    if not accounts:
         await query.edit_message_text(
-            text,
+            "暂无账户",
             reply_markup=get_accounts_menu_keyboard()
         )
-    
-    elif data == "delete_account":
-        accounts = await get_accounts(user_id)
-        if not accounts:
-            await query.edit_message_text(
-                "暂无账户可删除",
-                reply_markup=get_accounts_menu_keyboard()
-            )
-        else:
-            keyboard = []
-            for acc in accounts:
-                keyboard.append([
-                    InlineKeyboardButton(
-                        f"删除 {acc['phone'] or acc['id']}",
-                        callback_data=f"del_acc_{acc['id']}"
-                    )
-                ])
-            keyboard.append([
-                InlineKeyboardButton("🔙 返回", callback_data="menu_accounts")
-            ])
-            
-            await query.edit_message_text(
-                "选择要删除的账户：",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+    else:
+        await query.edit_message_text(f"🔄 正在刷新状态... 0/{len(accounts)}")
+        
+        progress = make_progress_callback(
+            query.edit_message_text,
+            lambda done, total, counts: (
+                f"🔄 正在刷新状态... {done}/{total}\n"
+                f"🟢 在线: {counts['online']}  🔴 离线: {counts['offline']}  🗑️ 封禁: {counts['removed']}"
             )
-    
-    elif data.startswith("del_acc_"):
-        account_id = int(data.split("_")[2])
-        await delete_account(account_id)
+        )
+        counts = await refresh_accounts_status(accounts, progress)
+        removed_count = counts["removed"]
+        
+        msg = f"✅ 状态已刷新\n🟢 在线: {counts['online']}  🔴 离线: {counts['offline']}"
+        if removed_count > 0:
+            msg += f"\n🗑️ 已自动删除 {removed_count} 个封禁/无效账户"
+        
         await query.edit_message_text(
-            "✅ 账户已删除",
+            msg,
             reply_markup=get_accounts_menu_keyboard()
         )
+
+# 链接管理
+@callback_route("menu_links")
+async def on_menu_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """链接管理菜单"""
+    query = update.callback_query
+    
+    await query.edit_message_text(
+        "🔗 链接管理",
+        reply_markup=get_links_menu_keyboard()
+    )
+
+@callback_route("add_link")
+async def on_add_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """添加链接"""
+    query = update.callback_query
+    
+    await query.edit_message_text(
+        "请发送群组/频道链接\n\n"
+        "支持格式：\n"
+        "1. https://t.me/groupname\n"
+        "2. @groupname\n"
+        "3. https://t.me/+invitehash\n\n"
+        "发送 /cancel 取消"
+    )
+    return ADD_LINK
+
+@callback_route("upload_txt")
+async def on_upload_txt(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """上传链接 TXT"""
+    query = update.callback_query
+    
+    await query.edit_message_text(
+        "请上传包含链接的 TXT 文件\n\n"
+        "格式：每行一个链接\n\n"
+        "发送 /cancel 取消"
+    )
+    return UPLOAD_TXT
+
+@callback_route("list_links")
+@callback_route("links_next_", prefix=True)
+@callback_route("links_prev_", prefix=True)
+async def on_list_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """链接列表 (分页)"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    
+    after_id, before_id = (None, None) if query.data == "list_links" else parse_page_callback(query.data)
+    links, offset, has_prev, has_next = await fetch_page(
+        "links", "id, link, kind", user_id, LINKS_PAGE_SIZE, after_id, before_id
+    )
+    if not links:
+        text = "📋 链接列表\n\n暂无链接"
+    else:
+        total = await count_rows("links", user_id)
+        text = f"📋 链接列表 (共 {total} 个)\n\n"
+        for idx, link in enumerate(links, offset + 1):
+            if link["kind"] == LINK_KIND_INVALID:
+                text += f"{idx}. ⚠️ {link['link']} (无法解析，已跳过)\n"
+            else:
+                text += f"{idx}. {link['link']}\n"
+    
+    nav = get_page_nav_row("links", links, has_prev, has_next)
+    await query.edit_message_text(
+        text,
+        reply_markup=with_nav_row(nav, get_links_menu_keyboard())
+    )
+
+@callback_route("clear_links")
+async def on_clear_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """清空链接确认"""
+    query = update.callback_query
+    
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ 确认清空", callback_data="confirm_clear_links"),
+            InlineKeyboardButton("❌ 取消", callback_data="menu_links"),
+        ]
+    ]
+    await query.edit_message_text(
+        "⚠️ 确定要清空所有链接吗？",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+@callback_route("confirm_clear_links")
+async def on_confirm_clear_links(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """清空链接"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    
+    await clear_links(user_id)
+    await query.edit_message_text(
+        "✅ 已清空所有链接",
+        reply_markup=get_links_menu_keyboard()
+    )
+
+# 设置
+@callback_route("menu_settings")
+async def on_menu_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """设置菜单"""
+    query = update.callback_query
+    user_id = query.from_user.id
     
-    elif data == "refresh_status":
-        accounts = await get_accounts(user_id)
-        if not accounts:
-            await query.edit_message_text(
-                "暂无账户",
-                reply_markup=get_accounts_menu_keyboard()
-            )
-        else:
-            await query.edit_message_text("🔄 正在刷新状态...")
-            
-            removed_count = 0
-            for acc in accounts:
-                is_online, status, is_banned = await check_account_status(acc["session_string"])
-                
-                if is_banned:
-                    # 自动删除封禁账户
-                    await delete_account(acc["id"])
-                    # 删除 session 文件
-                    if is_session_file_path(acc["session_string"]):
-                        session_path = acc["session_string"]
-                        if not session_path.endswith('.session'):
-                            session_path += '.session'
-                        if os.path.exists(session_path):
-                            os.remove(session_path)
-                    removed_count += 1
-                else:
-                    await update_account_status(
-                        acc["id"],
-                        "online" if is_online else "offline"
-                    )
-            
-            msg = "✅ 状态已刷新"
-            if removed_count > 0:
-                msg += f"\n🗑️ 已自动删除 {removed_count} 个封禁/无效账户"
-            
-            await query.edit_message_text(
-                msg,
-                reply_markup=get_accounts_menu_keyboard()
-            )
+    settings = await get_settings(user_id)
+    text = (
+        f"⚙️ 加群设置\n\n"
+        f"当前间隔: {settings['interval_min']}-{settings['interval_max']}秒\n"
+        f"每日上限: {settings['daily_limit']}个"
+    )
+    await query.edit_message_text(
+        text,
+        reply_markup=get_settings_menu_keyboard()
+    )
+
+@callback_route("set_interval")
+async def on_set_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """设置间隔"""
+    query = update.callback_query
     
-    # 链接管理
-    elif data == "menu_links":
-        await query.edit_message_text(
-            "🔗 链接管理",
-            reply_markup=get_links_menu_keyboard()
-        )
+    await query.edit_message_text(
+        "请发送时间间隔范围（秒）\n\n"
+        "格式: 最小值-最大值\n"
+        "例如: 30-60\n\n"
+        "发送 /cancel 取消"
+    )
+    return SET_INTERVAL
+
+@callback_route("set_limit")
+async def on_set_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """设置每日上限"""
+    query = update.callback_query
     
-    elif data == "add_link":
-        await query.edit_message_text(
-            "请发送群组/频道链接\n\n"
-            "支持格式：\n"
-            "1. https://t.me/groupname\n"
-            "2. @groupname\n"
-            "3. https://t.me/+invitehash\n\n"
-            "发送 /cancel 取消"
-        )
-        return ADD_LINK
+    await query.edit_message_text(
+        "请发送每日加群上限\n\n"
+        "例如: 50\n\n"
+        "发送 /cancel 取消"
+    )
+    return SET_LIMIT
+
+# 代理管理
+@callback_route("menu_proxy")
+async def on_menu_proxy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """代理管理菜单"""
+    query = update.callback_query
     
-    elif data == "upload_txt":
-        await query.edit_message_text(
-            "请上传包含链接的 TXT 文件\n\n"
-            "格式：每行一个链接\n\n"
-            "发送 /cancel 取消"
-        )
-        return UPLOAD_TXT
+    proxies = await load_proxies()
+    alive = len(proxy_registry.alive_records)
+    text = (
+        f"🌐 代理管理\n\n"
+        f"已加载代理: {len(proxies)} 个\n"
+        f"可用: {alive} 个 / 失效: {len(proxies) - alive} 个"
+    )
+    await query.edit_message_text(
+        text,
+        reply_markup=get_proxy_menu_keyboard()
+    )
+
+@callback_route("list_proxies")
+async def on_list_proxies(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """代理列表"""
+    query = update.callback_query
     
-    elif data == "list_links":
-        links = await get_links(user_id)
-        if not links:
-            text = "📋 链接列表\n\n暂无链接"
-        else:
-            text = f"📋 链接列表 (共 {len(links)} 个)\n\n"
-            for idx, link in enumerate(links[:20], 1):
-                text += f"{idx}. {link['link']}\n"
-            
-            if len(links) > 20:
-                text += f"\n... 还有 {len(links) - 20} 个链接"
+    proxies = await load_proxies()
+    if not proxies:
+        text = "📋 代理列表\n\n暂无代理\n\n请在脚本目录创建 proxy.txt 文件"
+    else:
+        text = f"📋 代理列表 (共 {len(proxies)} 个)\n\n"
+        for idx, proxy in enumerate(proxies[:10], 1):
+            text += f"{idx}. {mask_proxy(proxy)}\n"
         
-        await query.edit_message_text(
-            text,
-            reply_markup=get_links_menu_keyboard()
-        )
+        if len(proxies) > 10:
+            text += f"\n... 还有 {len(proxies) - 10} 个代理"
     
-    elif data == "clear_links":
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ 确认清空", callback_data="confirm_clear_links"),
-                InlineKeyboardButton("❌ 取消", callback_data="menu_links"),
-            ]
-        ]
-        await query.edit_message_text(
-            "⚠️ 确定要清空所有链接吗？",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    await query.edit_message_text(
+        text,
+        reply_markup=get_proxy_menu_keyboard()
+    )
+
+@callback_route("reload_proxies")
+async def on_reload_proxies(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """重新加载代理"""
+    query = update.callback_query
     
-    elif data == "confirm_clear_links":
-        await clear_links(user_id)
-        await query.edit_message_text(
-            "✅ 已清空所有链接",
-            reply_markup=get_links_menu_keyboard()
-        )
+    count = await reload_proxies()
+    await query.edit_message_text(
+        f"🔄 已重新加载 {count} 个代理",
+        reply_markup=get_proxy_menu_keyboard()
+    )
+
+@callback_route("test_proxy")
+async def on_test_proxy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """测试第一个代理"""
+    query = update.callback_query
     
-    # 设置
-    elif data == "menu_settings":
-        settings = await get_settings(user_id)
-        text = (
-            f"⚙️ 加群设置\n\n"
-            f"当前间隔: {settings['interval_min']}-{settings['interval_max']}秒\n"
-            f"每日上限: {settings['daily_limit']}个"
-        )
+    proxies = await load_proxies()
+    if not proxies:
         await query.edit_message_text(
-            text,
-            reply_markup=get_settings_menu_keyboard()
+            "❌ 暂无代理可测试\n\n请先添加代理到 proxy.txt",
+            reply_markup=get_proxy_menu_keyboard()
         )
-    
-    elif data == "set_interval":
+    else:
+        await query.edit_message_text("🧪 正在测试第一个代理...")
+        
+        success, message = await test_proxy(proxies[0])
+        
+        status_icon = "✅" if success else "❌"
         await query.edit_message_text(
-            "请发送时间间隔范围（秒）\n\n"
-            "格式: 最小值-最大值\n"
-            "例如: 30-60\n\n"
-            "发送 /cancel 取消"
+            f"{status_icon} 测试结果\n\n{message}",
+            reply_markup=get_proxy_menu_keyboard()
         )
-        return SET_INTERVAL
+
+@callback_route("sweep_proxies")
+async def on_sweep_proxies(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """检测全部代理"""
+    query = update.callback_query
     
-    elif data == "set_limit":
+    proxies = await load_proxies()
+    if not proxies:
         await query.edit_message_text(
-            "请发送每日加群上限\n\n"
-            "例如: 50\n\n"
-            "发送 /cancel 取消"
+            "❌ 暂无代理可检测\n\n请先添加代理到 proxy.txt",
+            reply_markup=get_proxy_menu_keyboard()
         )
-        return SET_LIMIT
-    
-    # 代理管理
-    elif data == "menu_proxy":
-        proxies = load_proxies()
-        text = (
-            f"🌐 代理管理\n\n"
-            f"已加载代理: {len(proxies)} 个"
+    else:
+        await query.edit_message_text(f"🩺 正在检测 {len(proxies)} 个代理...")
+        
+        progress = make_progress_callback(
+            query.edit_message_text, lambda done, total: f"🩺 正在检测代理... {done}/{total}"
         )
+        alive, dead = await sweep_proxies(progress)
         await query.edit_message_text(
-            text,
+            f"🩺 检测完成\n\n可用: {alive} 个\n失效: {dead} 个 (加群任务将跳过)",
             reply_markup=get_proxy_menu_keyboard()
         )
+
+@callback_route("proxy_report_", prefix=True)
+async def on_proxy_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """代理检测报告 (proxy_report_<排序>)"""
+    query = update.callback_query
+    data = query.data
+    
+    sort_key = data[len("proxy_report_"):]
+    health = await get_proxy_health()
+    checked = [
+        (proxy, health[proxy.raw]) for proxy in await load_proxies() if proxy.raw in health
+    ]
     
-    elif data == "list_proxies":
-        proxies = load_proxies()
-        if not proxies:
-            text = "📋 代理列表\n\n暂无代理\n\n请在脚本目录创建 proxy.txt 文件"
+    if not checked:
+        text = "📈 检测报告\n\n暂无检测结果，请先点击「全部检测」"
+    else:
+        latencies = [h["latency_ms"] for _, h in checked if h["ok"]]
+        dead = sum(1 for _, h in checked if not h["ok"])
+        if sort_key == "fails":
+            checked.sort(key=lambda item: -item[1]["fail_count"])
         else:
-            text = f"📋 代理列表 (共 {len(proxies)} 个)\n\n"
-            for idx, proxy in enumerate(proxies[:10], 1):
-                text += f"{idx}. {mask_proxy(proxy)}\n"
-            
-            if len(proxies) > 10:
-                text += f"\n... 还有 {len(proxies) - 10} 个代理"
+            # 可用的按延迟升序，失效的排在最后
+            checked.sort(key=lambda item: (not item[1]["ok"], item[1]["latency_ms"] or 0))
         
-        await query.edit_message_text(
-            text,
-            reply_markup=get_proxy_menu_keyboard()
+        text = (
+            f"📈 检测报告 (已检测 {len(checked)} 个)\n\n"
+            f"可用: {len(latencies)} / 失效: {dead}\n"
+            f"延迟 p50: {percentile(latencies, 50):.0f}ms\n"
+            f"延迟 p95: {percentile(latencies, 95):.0f}ms\n\n"
         )
+        for proxy, h in checked[:15]:
+            icon = "✅" if h["ok"] else "❌"
+            latency = f"{h['latency_ms']:.0f}ms" if h["ok"] else "超时/失败"
+            text += f"{icon} {mask_proxy(proxy)} | {latency} | 失败 {h['fail_count']}/{h['check_count']}\n"
+        if len(checked) > 15:
+            text += f"\n... 还有 {len(checked) - 15} 个代理"
+    
+    keyboard = [
+        [
+            InlineKeyboardButton("⏱️ 按延迟", callback_data="proxy_report_latency"),
+            InlineKeyboardButton("❌ 按失败次数", callback_data="proxy_report_fails"),
+        ],
+        [InlineKeyboardButton("🔙 返回", callback_data="menu_proxy")],
+    ]
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+# 任务控制
+@callback_route("start_task")
+async def on_start_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """开始任务 / 查看运行中的任务"""
+    query = update.callback_query
+    user_id = query.from_user.id
     
-    elif data == "reload_proxies":
-        count = reload_proxies()
+    controller = get_task_controller(user_id)
+    if controller is not None and controller.progress is not None:
+        # 任务已在运行: 状态消息改为当前这条
+        controller.progress.message = query.message
+        await controller.progress.refresh(force=True)
+    elif controller is not None:
         await query.edit_message_text(
-            f"🔄 已重新加载 {count} 个代理",
-            reply_markup=get_proxy_menu_keyboard()
+            "⏳ 任务正在启动...",
+            reply_markup=get_task_control_keyboard(user_id)
         )
+    else:
+        # 在后台运行任务，run_join_task 会把这条消息作为实时状态消息
+        await query.edit_message_text("⏳ 正在启动任务...")
+        controller = TaskController(user_id)
+        task_controllers[user_id] = controller
+        controller.start(run_join_task(user_id, update, context, controller))
+
+@callback_route("task_report")
+async def on_task_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """下载任务报告"""
+    query = update.callback_query
+    user_id = query.from_user.id
     
-    elif data == "test_proxy":
-        proxies = load_proxies()
-        if not proxies:
-            await query.edit_message_text(
-                "❌ 暂无代理可测试\n\n请先添加代理到 proxy.txt",
-                reply_markup=get_proxy_menu_keyboard()
-            )
-        else:
-            await query.edit_message_text("🧪 正在测试第一个代理...")
-            
-            success, message = await test_proxy(proxies[0])
-            
-            status_icon = "✅" if success else "❌"
-            await query.edit_message_text(
-                f"{status_icon} 测试结果\n\n{message}",
-                reply_markup=get_proxy_menu_keyboard()
-            )
-    
-    # 任务控制
-    elif data == "start_task":
-        if task_running.get(user_id):
-            success_count, failed_count = await get_today_stats(user_id)
-            settings = await get_settings(user_id)
-            status = "暂停中" if task_paused.get(user_id) else "运行中"
-            
-            text = (
-                f"🚀 任务控制\n\n"
-                f"状态: {status}\n"
-                f"进度: {success_count}/{settings['daily_limit']}\n"
-                f"失败: {failed_count}"
-            )
-            await query.edit_message_text(
-                text,
-                reply_markup=get_task_control_keyboard(user_id)
-            )
-        else:
-            await query.edit_message_text("⏳ 正在启动任务...")
-            
-            # 在后台运行任务
-            asyncio.create_task(run_join_task(user_id, update, context))
-            
-            await asyncio.sleep(1)
-            
-            success_count, failed_count = await get_today_stats(user_id)
-            settings = await get_settings(user_id)
-            
-            text = (
-                f"🚀 任务控制\n\n"
-                f"状态: 运行中\n"
-                f"进度: {success_count}/{settings['daily_limit']}\n"
-                f"失败: {failed_count}"
-            )
-            await query.edit_message_text(
-                text,
-                reply_markup=get_task_control_keyboard(user_id)
-            )
+    report_path = get_task_report_path(user_id)
+    try:
+        content = await asyncio.to_thread(Path(report_path).read_bytes)
+    except FileNotFoundError:
+        await query.message.reply_text("❌ 暂无任务报告")
+        return
+    await query.message.reply_document(content, filename=os.path.basename(report_path))
+
+@callback_route("pause_task")
+async def on_pause_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """暂停任务"""
+    query = update.callback_query
+    user_id = query.from_user.id
     
-    elif data == "pause_task":
-        task_paused[user_id] = True
+    controller = get_task_controller(user_id)
+    if controller is not None:
+        controller.pause()
+    await stats_writer.flush()
+    if controller is not None and controller.progress is not None:
+        controller.progress.message = query.message
+        await controller.progress.refresh(force=True)
+    else:
         await query.edit_message_text(
             "⏸️ 任务已暂停",
             reply_markup=get_task_control_keyboard(user_id)
         )
+
+@callback_route("resume_task")
+async def on_resume_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """继续任务"""
+    query = update.callback_query
+    user_id = query.from_user.id
     
-    elif data == "resume_task":
-        task_paused[user_id] = False
+    controller = get_task_controller(user_id)
+    if controller is not None:
+        controller.resume()
+    if controller is not None and controller.progress is not None:
+        controller.progress.message = query.message
+        await controller.progress.refresh(force=True)
+    else:
         await query.edit_message_text(
             "▶️ 任务已继续",
             reply_markup=get_task_control_keyboard(user_id)
         )
+
+@callback_route("stop_task")
+async def on_stop_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """停止任务"""
+    query = update.callback_query
+    user_id = query.from_user.id
     
-    elif data == "stop_task":
-        task_running[user_id] = False
-        task_paused[user_id] = False
+    controller = get_task_controller(user_id)
+    if controller is not None:
+        controller.stop()
+    await stats_writer.flush()
+    if controller is not None and controller.progress is not None:
+        # 任务结束时会在这条消息上显示最终结果
+        controller.progress.message = query.message
+        await controller.progress.refresh(force=True)
+    else:
         await query.edit_message_text(
             "⏹️ 任务已停止",
             reply_markup=get_main_menu_keyboard()
         )
+
+# 统计
+@callback_route("show_stats")
+@callback_route("stats_days_", prefix=True)
+async def on_show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """统计面板 (stats_days_<天数> 切换时间范围)"""
+    query = update.callback_query
+    user_id = query.from_user.id
     
-    # 统计
-    elif data == "show_stats":
-        success_count, failed_count = await get_today_stats(user_id)
-        total = success_count + failed_count
-        success_rate = (success_count / total * 100) if total > 0 else 0
-        
-        text = (
-            f"📊 统计面板\n\n"
-            f"今日成功: {success_count}\n"
-            f"今日失败: {failed_count}\n"
-            f"成功率: {success_rate:.1f}%\n"
-        )
-        
-        keyboard = [[InlineKeyboardButton("🔙 返回主菜单", callback_data="main_menu")]]
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    days = 7 if query.data == "show_stats" else int(query.data.rpartition("_")[2])
+    data = await get_stats_dashboard(user_id, days)
+    text = render_stats_dashboard(data, days)
     
-    # 日志
-    elif data == "show_logs":
-        stats = await get_stats(user_id, limit=10)
-        
-        if not stats:
-            text = "📋 日志查看\n\n暂无日志"
-        else:
-            text = "📋 最近10条日志\n\n"
-            for stat in stats:
-                status_icon = "✅" if stat["status"] == "success" else "❌"
-                timestamp = stat["timestamp"].split(".")[0]
-                text += f"{status_icon} {timestamp}\n"
-                text += f"   链接: {stat['link']}\n"
-                text += f"   {stat['message']}\n\n"
-        
-        keyboard = [[InlineKeyboardButton("🔙 返回主菜单", callback_data="main_menu")]]
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    keyboard = [
+        [
+            InlineKeyboardButton(("· " if d == days else "") + f"{d}天", callback_data=f"stats_days_{d}")
+            for d in DASHBOARD_RANGES
+        ],
+        [InlineKeyboardButton("🔙 返回主菜单", callback_data="main_menu")],
+    ]
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+# 日志
+@callback_route("show_logs")
+@callback_route("logs_next_", prefix=True)
+@callback_route("logs_prev_", prefix=True)
+async def on_show_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """日志 (新到旧分页)"""
+    query = update.callback_query
+    user_id = query.from_user.id
     
-    return ConversationHandler.END
+    after_id, before_id = (None, None) if query.data == "show_logs" else parse_page_callback(query.data)
+    stats, offset, has_prev, has_next = await fetch_page(
+        "stats_view", "id, link, outcome, detail, error, timestamp", user_id, LOGS_PAGE_SIZE,
+        after_id, before_id, newest_first=True
+    )
+    stats = [describe_stat_row(stat) for stat in stats]
+    
+    if not stats:
+        text = "📋 日志查看\n\n暂无日志"
+    else:
+        total = await count_rows("stats", user_id)
+        text = f"📋 日志 ({offset + 1}-{offset + len(stats)} / 共 {total} 条)\n\n"
+        for stat in stats:
+            status_icon = "✅" if stat["status"] == "success" else "❌"
+            timestamp = stat["timestamp"].split(".")[0]
+            text += f"{status_icon} {timestamp}\n"
+            text += f"   链接: {stat['link']}\n"
+            text += f"   {stat['message']}\n\n"
+    
+    keyboard = [
+        [InlineKeyboardButton("📦 导出全部记录", callback_data="export_stats")],
+        [InlineKeyboardButton("🔙 返回主菜单", callback_data="main_menu")],
+    ]
+    nav = get_page_nav_row("logs", stats, has_prev, has_next)
+    await query.edit_message_text(
+        text,
+        reply_markup=with_nav_row(nav, InlineKeyboardMarkup(keyboard))
+    )
+
+@callback_route("export_stats")
+async def on_export_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """导出全部统计记录 (含已归档)"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    
+    status_message = await query.message.reply_text("📦 正在导出记录...")
+    await stats_writer.flush()
+    
+    export_path = await asyncio.to_thread(make_temp_file, ".zip")
+    try:
+        count = await export_user_stats(user_id, export_path)
+        if count == 0:
+            await status_message.edit_text("📋 暂无记录可导出")
+            return
+        content = await asyncio.to_thread(Path(export_path).read_bytes)
+        await query.message.reply_document(
+            content,
+            filename=f"stats_{user_id}_{datetime.now():%Y%m%d}.zip",
+            caption=f"共 {count} 条记录"
+        )
+        await status_message.delete()
+    finally:
+        await asyncio.to_thread(os.remove, export_path)
 
 # ============== 消息处理 ==============
 
@@ -1245,16 +4480,24 @@ async def handle_upload_account(update: Update, context: ContextTypes.DEFAULT_TY
         file = await update.message.document.get_file()
         file_name = update.message.document.file_name
         
-        # 使用安全的临时文件
-        with tempfile.NamedTemporaryFile(mode='wb', delete=False, suffix=os.path.splitext(file_name)[1]) as tmp_file:
-            temp_path = tmp_file.name
+        # 小文件留在内存，超过阈值才落到临时文件
+        upload = await asyncio.to_thread(open_upload_buffer, update.message.document.file_size)
         
         try:
-            await file.download_to_drive(temp_path)
+            await file.download_to_memory(out=upload)
+            upload.seek(0)
             
             if file_name.endswith(".zip"):
-                # 处理 ZIP 文件
-                success, message, phones = await process_zip_account(temp_path, user_id)
+                # 处理 ZIP 文件 (逐步显示验证进度)
+                status_message = await update.message.reply_text("📦 正在导入 ZIP 中的账户...")
+                progress = make_progress_callback(
+                    status_message.edit_text,
+                    lambda done, total, ok, failed: (
+                        f"📦 正在验证 session... {done}/{total}\n"
+                        f"✅ 成功: {ok}  ❌ 失败: {failed}"
+                    )
+                )
+                success, message, phones = await process_zip_account(upload, user_id, progress)
                 
                 text = message
                 if phones:
@@ -1277,7 +4520,7 @@ async def handle_upload_account(update: Update, context: ContextTypes.DEFAULT_TY
             
             elif file_name.endswith(".session"):
                 # 处理单个 session 文件
-                success, message, phone = await process_session_file(temp_path, user_id)
+                success, message, phone = await process_session_file(upload, file_name, user_id)
                 if success:
                     await update.message.reply_text(
                         f"✅ 账户添加成功\n手机号: {phone}",
@@ -1302,9 +4545,7 @@ async def handle_upload_account(update: Update, context: ContextTypes.DEFAULT_TY
                 reply_markup=get_accounts_menu_keyboard()
             )
         finally:
-            # 确保清理临时文件
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+            upload.close()
     
     elif update.message.text:
         # 处理手机号码 - 手动验证码登录
@@ -1341,17 +4582,41 @@ async def handle_upload_account(update: Update, context: ContextTypes.DEFAULT_TY
     return ConversationHandler.END
 
 
-async def process_session_file(file_path: str, user_id: int) -> Tuple[bool, str, str]:
-    """处理单个 session 文件，自动检测封禁状态"""
-    dest_path = None
+def stage_session_file(source: BinaryIO, user_id: int, session_name: str) -> str:
+    """把 session 内容直接写入 sessions 目录下一个不冲突的新文件，返回路径 (阻塞，在线程中调用)"""
+    suffix = 0
+    while True:
+        name = f"user_{user_id}_{session_name}" + (f"_{suffix}" if suffix else "")
+        dest_path = os.path.join(SESSIONS_DIR, f"{name}.session")
+        try:
+            # "x" 模式原子地占用文件名
+            with open(dest_path, "xb") as f:
+                shutil.copyfileobj(source, f)
+            return dest_path
+        except FileExistsError:
+            suffix += 1
+        except BaseException:
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
+            raise
+
+
+def remove_file_if_exists(path: str):
+    """删除文件，不存在时忽略 (阻塞，在线程中调用)"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def validate_session_file(dest_path: str) -> Tuple[bool, str, str, str]:
+    """联网验证已写入 sessions 目录的 session 文件 (不写数据库)
+    返回: (是否有效, 信息, 手机号, session 标识)
+    无效、异常或被取消 (超时) 时删除该文件
+    """
+    client = None
+    keep = False
     try:
-        # 使用 Telethon 加载 session 文件
-        session_name = os.path.splitext(os.path.basename(file_path))[0]
-        
-        # 将文件复制到 sessions 目录
-        dest_path = os.path.join(SESSIONS_DIR, f"user_{user_id}_{session_name}.session")
-        shutil.copy(file_path, dest_path)
-        
         # 尝试连接验证
         session_file = dest_path.replace('.session', '')
         client = TelegramClient(session_file, API_ID, API_HASH)
@@ -1363,166 +4628,207 @@ async def process_session_file(file_path: str, user_id: int) -> Tuple[bool, str,
             
             # 保存 session 文件路径到数据库 (使用文件路径作为标识)
             # 注意: 这里简化处理，直接使用相对路径
-            session_string = session_file
-            
-            await client.disconnect()
-            
-            # 保存到数据库
-            await add_account(user_id, phone, session_string)
-            
-            return True, f"手机号: {phone}", phone
+            keep = True
+            return True, f"手机号: {phone}", phone, session_file
         else:
-            await client.disconnect()
-            # 删除无效的 session 文件
-            if dest_path and os.path.exists(dest_path):
-                os.remove(dest_path)
-            return False, "Session 文件未授权或已过期", ""
+            return False, "Session 文件未授权或已过期", "", ""
     
     except errors.UserDeactivatedBanError:
-        # 清理文件，不保存
-        if dest_path and os.path.exists(dest_path):
-            os.remove(dest_path)
-        return False, "账户已被封禁 (banned)", ""
+        return False, "账户已被封禁 (banned)", "", ""
     
     except errors.UserDeactivatedError:
-        if dest_path and os.path.exists(dest_path):
-            os.remove(dest_path)
-        return False, "账户已被删除", ""
+        return False, "账户已被删除", "", ""
     
     except errors.AuthKeyUnregisteredError:
-        if dest_path and os.path.exists(dest_path):
-            os.remove(dest_path)
-        return False, "Session已失效", ""
+        return False, "Session已失效", "", ""
     
     except Exception as e:
         logger.error(f"处理 session 文件失败: {e}")
-        # 清理失败的文件
-        if dest_path and os.path.exists(dest_path):
+        return False, "Session 文件处理失败", "", ""
+    
+    finally:
+        if client is not None:
             try:
-                os.remove(dest_path)
-            except (OSError, FileNotFoundError) as cleanup_error:
+                await client.disconnect()
+            except Exception:
+                pass
+        # 清理无效/失败的文件，不保存
+        if not keep:
+            try:
+                await asyncio.to_thread(remove_file_if_exists, dest_path)
+            except OSError as cleanup_error:
                 logger.warning(f"清理文件失败: {cleanup_error}")
+
+
+async def process_session_file(source: BinaryIO, file_name: str, user_id: int) -> Tuple[bool, str, str]:
+    """处理单个 session 文件，自动检测封禁状态"""
+    session_name = os.path.splitext(os.path.basename(file_name))[0]
+    try:
+        dest_path = await asyncio.to_thread(stage_session_file, source, user_id, session_name)
+    except Exception as e:
+        logger.error(f"处理 session 文件失败: {e}")
         return False, "Session 文件处理失败", ""
+    
+    success, message, phone, session_string = await validate_session_file(dest_path)
+    if success:
+        # 保存到数据库
+        await add_account(user_id, phone, session_string)
+    return success, message, phone
 
 
-async def process_zip_account(zip_path: str, user_id: int) -> Tuple[bool, str, List[str]]:
-    """处理 ZIP 文件 - 支持批量导入多个 session 文件"""
-    with tempfile.TemporaryDirectory() as extract_dir:
-        try:
-            with zipfile.ZipFile(zip_path, "r") as zip_ref:
-                # 验证 zip 内容安全性
-                for member in zip_ref.namelist():
-                    # Check for path traversal
-                    if member.startswith('/') or '..' in member:
-                        return False, "ZIP 文件包含不安全的路径", []
-                    # Check file size (prevent zip bomb)
-                    info = zip_ref.getinfo(member)
-                    if info.file_size > MAX_ZIP_FILE_SIZE:
-                        return False, "ZIP 文件内容过大", []
-                
-                zip_ref.extractall(extract_dir)
-        except (zipfile.BadZipFile, ValueError) as e:
-            logger.warning(f"无效的 zip 文件: {e}")
-            return False, "ZIP 文件格式不正确", []
-        
-        # 检查是否是 tdata 格式
-        tdata_result = await process_tdata_format(extract_dir, user_id)
-        if tdata_result[0]:
-            # tdata format returns Tuple[bool, str, str], we need to convert to Tuple[bool, str, List[str]]
-            return tdata_result[0], tdata_result[1], [tdata_result[2]] if tdata_result[2] else []
-        
-        # 检查是否有 session 文件
-        session_files = []
-        
-        for root, dirs, files in os.walk(extract_dir):
-            for file in files:
-                if file.endswith('.session'):
-                    session_files.append(os.path.join(root, file))
-        
-        if not session_files:
-            return False, "ZIP 文件中未找到有效的 session 或 tdata 文件", []
-        
-        # 批量处理所有 session 文件
-        success_list = []
-        failed_list = []
-        banned_list = []
-        
-        for session_file in session_files:
-            result = await process_session_file(session_file, user_id)
-            if result[0]:  # 成功
-                success_list.append(result[2])  # phone
-            elif "banned" in result[1].lower() or "禁" in result[1] or "封" in result[1]:
-                banned_list.append((os.path.basename(session_file), result[1]))
-            else:
-                failed_list.append((os.path.basename(session_file), result[1]))
-        
-        # 返回统计信息
-        message = f"✅ 批量导入完成\n成功: {len(success_list)} 个\n失败: {len(failed_list)} 个"
-        if banned_list:
-            message += f"\n封禁/冻结: {len(banned_list)} 个（已跳过）"
+async def import_session_files(sources: List[Tuple[str, Callable[[], BinaryIO]]], user_id: int, progress=None) -> Tuple[List[str], List[Tuple[str, str]], List[Tuple[str, str]]]:
+    """批量导入流水线: 写入 session 文件 → 并发验证 (限流 + 超时) → 一次性批量写入成功的账户
+    sources: [(文件名, 打开内容流的函数), ...]，文件在轮到验证时才在线程中写入磁盘
+    progress: 可选回调 progress(已完成, 总数, 成功数, 失败数)
+    返回: (成功手机号列表, 失败列表, 封禁列表)
+    """
+    semaphore = asyncio.Semaphore(SESSION_VALIDATE_CONCURRENCY)
+    
+    async def validate_one(file_name: str, opener: Callable[[], BinaryIO]):
+        async with semaphore:
+            session_name = os.path.splitext(os.path.basename(file_name))[0]
+            def stage() -> str:
+                with opener() as source:
+                    return stage_session_file(source, user_id, session_name)
+            
+            try:
+                dest_path = await asyncio.to_thread(stage)
+            except Exception as e:
+                logger.error(f"写入 session 文件失败: {e}")
+                return file_name, (False, "Session 文件处理失败", "", "")
+            
+            try:
+                result = await asyncio.wait_for(
+                    validate_session_file(dest_path),
+                    SESSION_VALIDATE_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                result = (False, "验证超时", "", "")
+            return file_name, result
+    
+    new_accounts = []
+    success_list = []
+    failed_list = []
+    banned_list = []
+    
+    tasks = [validate_one(name, opener) for name, opener in sources]
+    for done, future in enumerate(asyncio.as_completed(tasks), 1):
+        file_name, (success, message, phone, session_string) = await future
+        if success:
+            new_accounts.append((phone, session_string))
+            success_list.append(phone)
+        elif "banned" in message.lower() or "禁" in message or "封" in message:
+            banned_list.append((os.path.basename(file_name), message))
+        else:
+            failed_list.append((os.path.basename(file_name), message))
         
-        return len(success_list) > 0, message, success_list
+        if progress:
+            await progress(done, len(sources), len(success_list), len(failed_list) + len(banned_list))
+    
+    # 一个事务写入所有成功的账户
+    if new_accounts:
+        await add_accounts_batch(user_id, new_accounts)
+    
+    return success_list, failed_list, banned_list
 
 
-async def process_tdata_format(extract_dir: str, user_id: int) -> Tuple[bool, str, str]:
-    """处理 tdata 格式: phone_number/tdata/D877F783D5D3EF8C/key_datas"""
+async def process_zip_account(zip_source: BinaryIO, user_id: int, progress=None) -> Tuple[bool, str, List[str]]:
+    """处理 ZIP 文件 - 支持批量导入多个 session 文件
+    直接从压缩包读取需要的成员，不解压其他文件
+    progress: 可选回调，见 import_session_files
+    """
     try:
-        # 遍历查找 tdata 结构
-        for item in os.listdir(extract_dir):
-            item_path = os.path.join(extract_dir, item)
-            if not os.path.isdir(item_path):
-                continue
+        # 读取目录在线程中进行；成员内容由 import_session_files 在线程中读出
+        zip_ref = await asyncio.to_thread(zipfile.ZipFile, zip_source, "r")
+        with zip_ref:
+            infos = zip_ref.infolist()
             
-            # 检查是否是手机号格式
-            phone_candidate = item
-            cleaned = clean_phone_number(phone_candidate)
-            if not cleaned.isdigit():
-                continue
+            # 验证 zip 内容安全性 (所有成员)
+            for info in infos:
+                # Check for path traversal
+                if info.filename.startswith('/') or '..' in info.filename:
+                    return False, "ZIP 文件包含不安全的路径", []
+                # Check file size (prevent zip bomb)
+                if info.file_size > MAX_ZIP_FILE_SIZE:
+                    return False, "ZIP 文件内容过大", []
             
-            # 查找 tdata 目录
-            tdata_path = os.path.join(item_path, "tdata")
-            if not os.path.exists(tdata_path):
-                continue
+            # 检查是否有 session 文件
+            session_members = [
+                info for info in infos
+                if not info.is_dir() and info.filename.endswith('.session')
+            ]
             
-            # 查找类似 D877F783D5D3EF8C 的子目录和 key_datas 文件
-            found_valid = False
-            for subdir in os.listdir(tdata_path):
-                subdir_path = os.path.join(tdata_path, subdir)
-                if not os.path.isdir(subdir_path):
-                    continue
-                
-                key_datas_path = os.path.join(subdir_path, "key_datas")
-                if os.path.exists(key_datas_path):
-                    found_valid = True
-                    break
+            if not session_members:
+                # 检查是否是 tdata 格式
+                tdata_phone = detect_tdata_phone([info.filename for info in infos])
+                if tdata_phone:
+                    # 注意：tdata 格式需要使用 Telegram Desktop 的 API 或专门的转换工具
+                    logger.info(f"发现 tdata 格式，手机号: {tdata_phone}")
+                    return False, f"检测到 tdata 格式 (手机号: {tdata_phone})\n该格式需要特殊转换工具\n建议使用 session 文件替代", []
+                return False, "ZIP 文件中未找到有效的 session 或 tdata 文件", []
             
-            if found_valid:
-                # 找到有效的 tdata 格式
-                # 注意：tdata 格式需要使用 Telegram Desktop 的 API 或专门的转换工具
-                logger.info(f"发现 tdata 格式，手机号: {phone_candidate}")
-                return False, f"检测到 tdata 格式 (手机号: {phone_candidate})\n该格式需要特殊转换工具\n建议使用 session 文件替代", phone_candidate
+            # 批量处理所有 session 文件 (成员内容在验证前才从压缩包读出)
+            sources = [
+                (info.filename, lambda info=info: zip_ref.open(info))
+                for info in session_members
+            ]
+            success_list, failed_list, banned_list = await import_session_files(
+                sources, user_id, progress
+            )
+    except (zipfile.BadZipFile, ValueError) as e:
+        logger.warning(f"无效的 zip 文件: {e}")
+        return False, "ZIP 文件格式不正确", []
+    
+    # 返回统计信息
+    message = f"✅ 批量导入完成\n成功: {len(success_list)} 个\n失败: {len(failed_list)} 个"
+    if banned_list:
+        message += f"\n封禁/冻结: {len(banned_list)} 个（已跳过）"
+    
+    return len(success_list) > 0, message, success_list
+
+
+def detect_tdata_phone(names: List[str]) -> Optional[str]:
+    """从压缩包成员名识别 tdata 格式: phone_number/tdata/D877F783D5D3EF8C/key_datas
+    返回手机号，未识别时返回 None
+    """
+    for name in names:
+        parts = name.strip('/').split('/')
+        if len(parts) != 4:
+            continue
+        phone_candidate, tdata_dir, subdir, marker = parts
         
-        return False, "", ""
+        # 检查是否是手机号格式，以及 tdata/<子目录>/key_datas 结构
+        if (
+            clean_phone_number(phone_candidate).isdigit()
+            and tdata_dir == "tdata"
+            and subdir
+            and marker == "key_datas"
+        ):
+            return phone_candidate
     
-    except Exception as e:
-        logger.error(f"处理 tdata 格式失败: {e}")
-        return False, "", ""
+    return None
 
 async def handle_add_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理添加链接"""
     user_id = update.effective_user.id
-    link = update.message.text.strip()
+    parsed = parse_link(update.message.text)
+    
+    if parsed is None:
+        await update.message.reply_text(
+            "❌ 链接格式不正确",
+            reply_markup=get_links_menu_keyboard()
+        )
+        return ConversationHandler.END
     
-    # 简单验证
-    if "t.me/" in link or link.startswith("@") or link.startswith("+"):
-        await add_link(user_id, link)
+    link = parsed[0]
+    if await add_link(user_id, parsed):
         await update.message.reply_text(
             f"✅ 链接已添加\n{link}",
             reply_markup=get_links_menu_keyboard()
         )
     else:
         await update.message.reply_text(
-            "❌ 链接格式不正确",
+            f"⚠️ 链接已存在\n{link}",
             reply_markup=get_links_menu_keyboard()
         )
     
@@ -1536,24 +4842,18 @@ async def handle_upload_txt(update: Update, context: ContextTypes.DEFAULT_TYPE):
         file = await update.message.document.get_file()
         
         # 使用安全的临时文件
-        with tempfile.NamedTemporaryFile(mode='wb', delete=False, suffix='.txt') as tmp_file:
-            temp_path = tmp_file.name
+        temp_path = await asyncio.to_thread(make_temp_file, ".txt")
         
         try:
             await file.download_to_drive(temp_path)
             
-            with open(temp_path, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-            
-            count = 0
-            for line in lines:
-                link = line.strip()
-                if link and ("t.me/" in link or link.startswith("@") or link.startswith("+")):
-                    await add_link(user_id, link)
-                    count += 1
+            added, duplicates, invalid = await import_links_file(user_id, temp_path)
             
             await update.message.reply_text(
-                f"✅ 成功添加 {count} 个链接",
+                f"✅ 导入完成\n"
+                f"新增: {added} 个\n"
+                f"重复: {duplicates} 个\n"
+                f"无效: {invalid} 个",
                 reply_markup=get_links_menu_keyboard()
             )
         except Exception as e:
@@ -1564,8 +4864,7 @@ async def handle_upload_txt(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         finally:
             # 确保清理临时文件
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+            await asyncio.to_thread(remove_file_if_exists, temp_path)
     else:
         await update.message.reply_text(
             "❌ 请上传 TXT 文件",
@@ -1642,42 +4941,75 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def post_init(application: Application):
     """启动后初始化"""
+    await open_db()
     await init_db()
+    stats_writer.start()
+    stats_archiver.start()
+    loop_monitor.start()
+    await evict_entity_cache(ENTITY_CACHE_MAX_ENTRIES)
+    await load_proxies()
+    proxy_registry.set_dead(await get_dead_proxies())
     logger.info("数据库初始化完成")
 
+async def post_stop(application: Application):
+    """停止轮询后: 先结束加群任务 (此时 bot 仍可用，任务能发出最终状态)"""
+    await stop_all_join_tasks(TASK_SHUTDOWN_TIMEOUT)
+
+async def post_shutdown(application: Application):
+    """关闭前清理 (加群任务必须先于统计写入和数据库结束)"""
+    await stop_all_join_tasks(TASK_SHUTDOWN_TIMEOUT)
+    await loop_monitor.stop()
+    await stats_archiver.stop()
+    await stats_writer.stop()
+    await close_db()
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """记录处理器中未捕获的异常"""
+    logger.error(f"处理更新时出错: {context.error}", exc_info=context.error)
+
 def main():
     """主函数"""
     # 创建应用
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .rate_limiter(bot_dispatcher)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # 添加 /start 命令处理器
-    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("start", monitored(start_command)))
+    application.add_handler(CommandHandler("perf", monitored(perf_command)))
     
     # 添加会话处理器
     conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(button_callback)],
         states={
             UPLOAD_ACCOUNT: [
-                MessageHandler(filters.ALL & ~filters.COMMAND, handle_upload_account)
+                MessageHandler(filters.ALL & ~filters.COMMAND, monitored(handle_upload_account))
             ],
             ADD_LINK: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_add_link)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, monitored(handle_add_link))
             ],
             UPLOAD_TXT: [
-                MessageHandler(filters.Document.ALL, handle_upload_txt)
+                MessageHandler(filters.Document.ALL, monitored(handle_upload_txt))
             ],
             SET_INTERVAL: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_set_interval)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, monitored(handle_set_interval))
             ],
             SET_LIMIT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_set_limit)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, monitored(handle_set_limit))
             ],
         },
-        fallbacks=[CommandHandler("cancel", cancel)],
+        fallbacks=[CommandHandler("cancel", monitored(cancel))],
         allow_reentry=True,
     )
     
     application.add_handler(conv_handler)
+    application.add_error_handler(error_handler)
     
     # 启动机器人
     logger.info("机器人启动中...")